@@ -5,9 +5,13 @@ from flask_restplus import Api
 from chatbot.api.v1.dialogflow import dialog_api as v1_dialog_api
 from chatbot.api.v1.web import web_api as v1_web_api
 from chatbot.api.v2.api import api as v2_api
+from chatbot.model.model_factory import ModelFactory
 
 app = Flask(__name__)
 
+# Make sure the indexes used by the APIs exist, and report the missing ones
+ModelFactory.get_instance().ensure_indexes()
+
 # Register version 1 blueprints. These two APIs does not use flask_restplus,
 # but define their own namespaces of '/v1/dialogflow' and '/v1/web'
 # They are are also not documented through Swagger
@@ -13,3 +13,18 @@ def create_success_response(message, data=None):
     response["message"] = message
 
     return json.dumps(response)
+
+
+def create_error_response(message):
+    """ Create JSON error response """
+
+    return json.dumps({"status": "ERROR", "message": message})
+
+
+def stream_json_list(items):
+    """ Generate a JSON list from an iterable, one item at a time """
+
+    yield "["
+    for i, item in enumerate(items):
+        yield ("," if i else "") + json.dumps(item)
+    yield "]"
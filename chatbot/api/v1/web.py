@@ -1,9 +1,11 @@
 import json
 
-from flask import request, Blueprint
+from flask import request, Blueprint, Response
 
 from chatbot.model.model_factory import ModelFactory
+from chatbot.model.unknown_query_log import UnknownQueryLog
 from chatbot.nlp.keyword import lemmatize_content_keywords
+from chatbot.nlp.query_cache import QueryCache
 from chatbot.util.config_util import Config
 import chatbot.api.v1.util as flask_util
 
@@ -16,6 +18,10 @@ web_api = Blueprint('Website APIv1',
 factory = ModelFactory.get_instance()
 factory.set_db()
 
+query_cache = QueryCache.get_instance()
+
+unknown_query_log = UnknownQueryLog.get_instance()
+
 prod_col = Config.get_mongo_collection("prod")
 manual_col = Config.get_mongo_collection("manual")
 conflict_col = Config.get_mongo_collection("conflicts")
@@ -25,20 +31,45 @@ unknown_col = Config.get_mongo_collection("unknown")
 @web_api.route("/conflict_ids", methods=["GET"])
 def get_all_conflict_ids():
     """
-    :return: a list of {"title" "...", "id": "..."}
+    :return: a list of {"title" "...", "id": "..."}, paginated if a limit and
+    cursor are given
     """
-    conflict_ids_docs = factory.get_collection(conflict_col).find()
-    conflict_ids = []
+    query = {"conflict_id": {"$exists": True}}
+    return get_list_response(conflict_col, ["conflict_id", "title"],
+                             lambda doc: {"id": doc["conflict_id"],
+                                          "title": doc.get("title")},
+                             query=query)
+
+
+def get_list_response(collection, projection, serialize, query=None):
+    """ List the documents in collection, with only the fields in projection.
+    If a limit is given in the request, a page of at most limit documents
+    following the cursor in the request is returned, and the cursor of the
+    next page is returned in the X-Next-Cursor header. Otherwise every
+    document is streamed """
+    limit = request.args.get("limit")
+    cursor = request.args.get("cursor")
+
+    if limit is not None:
+        if not limit.isdigit() or int(limit) == 0:
+            return flask_util.create_error_response(
+                "Limit must be a positive integer"), 400
+        limit = int(limit)
 
-    # Validate if result is empty or does not contain keys
     try:
-        for conflict_id_doc in conflict_ids_docs:
-            conflict_ids.append({"id": conflict_id_doc["conflict_id"],
-                                 "title": conflict_id_doc["title"]})
-    except KeyError:
-        pass
+        docs, next_cursor = factory.get_page(collection, query=query,
+                                             projection=projection,
+                                             limit=limit, cursor=cursor)
+    except ValueError as e:
+        return flask_util.create_error_response(str(e)), 400
+
+    docs = (serialize(doc) for doc in docs)
+    if limit is None:
+        return Response(flask_util.stream_json_list(docs),
+                        mimetype="application/json")
 
-    return json.dumps(conflict_ids)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    return json.dumps(list(docs)), 200, headers
 
 
 @web_api.route("/content/", methods=["GET"])
@@ -91,6 +122,9 @@ def update_content():
     # delete this document from the conflict ids collection
     query = {"conflict_id": id}
     factory.get_database().get_collection(conflict_col).delete_one(query)
+
+    # Answers to queries might have changed.
+    query_cache.invalidate()
     return flask_util.create_success_response("Success")
 
 
@@ -121,6 +155,9 @@ def delete_manual_document():
            .update({"id": document_id}, {"$set": {"manually_changed": False}})
     factory.get_database().get_collection(conflict_col) \
                           .delete_one({"conflict_id": document_id})
+
+    # Answers to queries might have changed.
+    query_cache.invalidate()
     success_msg = "Successfully deleted manual entry"
     return flask_util.create_success_response(success_msg)
 
@@ -132,6 +169,11 @@ def delete_unknown_query():
     """
     json_input_data = json.loads(request.data)
     query_text = json_input_data["data"]["query_text"]
+    # Write queued queries first, so the query is not logged again after it
+    # is deleted
+    if not unknown_query_log.flush():
+        return flask_util.create_error_response(
+            "Could not write the queued unknown queries"), 503
     factory.get_database() \
            .get_collection(unknown_col) \
            .delete_one({"query_text": query_text})
@@ -142,9 +184,12 @@ def delete_unknown_query():
 @web_api.route("/unknown_queries", methods=["GET"])
 def get_all_unknown_queries():
     """
-    :return: a list of unknown queries.
+    :return: a list of unknown queries, paginated if a limit and cursor are
+    given.
     """
-    unknown_queries_docs = factory.get_collection(unknown_col).find()
-    unknown_queries = [{"query_text": unknown_query_doc["query_text"]}
-                       for unknown_query_doc in unknown_queries_docs]
-    return json.dumps(unknown_queries)
+    # Include the queries which are still queued
+    if not unknown_query_log.flush():
+        return flask_util.create_error_response(
+            "Could not write the queued unknown queries"), 503
+    return get_list_response(unknown_col, ["query_text"],
+                             lambda doc: {"query_text": doc["query_text"]})
@@ -3,6 +3,8 @@ import chatbot.api.v2.models as models
 from flask_restplus import Namespace, Resource, fields, abort, reqparse
 
 from chatbot.model.model_factory import ModelFactory
+from chatbot.model.unknown_query_log import UnknownQueryLog
+from chatbot.nlp.query_cache import QueryCache
 from chatbot.util.config_util import Config
 
 
@@ -12,6 +14,10 @@ api = Namespace('v2', description='Chatbot APIv2')
 factory = ModelFactory.get_instance()
 factory.set_db()
 
+query_cache = QueryCache.get_instance()
+
+unknown_query_log = UnknownQueryLog.get_instance()
+
 
 prod_col = Config.get_mongo_collection("prod")
 manual_col = Config.get_mongo_collection("manual")
@@ -24,6 +30,15 @@ direct_response_model = api.model('DirectResponse', {
     'response': fields.String(description='Bot chat response')
 })
 
+batch_request_model = api.model('BatchRequest', {
+    'queries': fields.List(fields.String, required=True,
+                           description='User chat inputs')
+})
+
+batch_response_model = api.model('BatchResponse', {
+    'responses': fields.List(fields.Nested(direct_response_model))
+})
+
 conflict_model = api.model('Conflict', {
     'id': fields.String(description='Document ID for conflict'),
     'title': fields.String(description='Title of conflict content')
@@ -78,17 +93,59 @@ class Response(Resource):
         return models.DirectResponse(user_input=query)
 
 
+class BatchResponse(Resource):
+    @api.expect(batch_request_model)
+    @api.marshal_with(batch_response_model)
+    @api.response(400, 'Queries must be a list of strings')
+    def post(self):
+        queries = (api.payload or {}).get('queries')
+        if not isinstance(queries, list) or \
+                not all(isinstance(query, str) for query in queries):
+            abort(400, 'Queries must be a list of strings')
+
+        return models.BatchResponse(user_inputs=queries)
+
+
 class FullResponse(Resource):
     def get(self):
         pass
 
 
+page_parser = reqparse.RequestParser()
+page_parser.add_argument('limit', type=int,
+                         help='Maximum number of items to return')
+page_parser.add_argument('cursor',
+                         help='Cursor from the X-Next-Cursor header of the '
+                              'previous page')
+
+
+def get_page(collection, projection):
+    """ Retrieve the page of documents requested through page_parser, and the
+    headers of the response """
+    args = page_parser.parse_args()
+    if args['limit'] is not None and args['limit'] < 1:
+        abort(400, 'Limit must be a positive integer')
+
+    try:
+        docs, next_cursor = factory.get_page(collection,
+                                             projection=projection,
+                                             limit=args['limit'],
+                                             cursor=args['cursor'])
+    except ValueError as e:
+        abort(400, str(e))
+
+    headers = {'X-Next-Cursor': next_cursor} if next_cursor else {}
+    return docs, headers
+
+
 class ConflictIDs(Resource):
     @api.marshal_with(conflict_model)
+    @api.expect(page_parser)
+    @api.response(400, 'Invalid limit or cursor')
     def get(self):
-        conflict_ids = factory.get_collection(conflict_col).find()
-        return [models.Conflict(conflict['id'], conflict['title'])
-                for conflict in conflict_ids]
+        conflict_ids, headers = get_page(conflict_col, ['id', 'title'])
+        return [models.Conflict(conflict.get('id'), conflict.get('title'))
+                for conflict in conflict_ids], 200, headers
 
     @api.marshal_with(delete_model)
     @api.response(200, 'Success', delete_model)
@@ -149,6 +206,9 @@ class Content(Resource):
         # Delete conflict if there was one
         factory.delete_document({'id': content_id}, conflict_col)
 
+        # Answers to queries might have changed
+        query_cache.invalidate()
+
         if result.deleted_count > 0:
             return result
         else:
@@ -199,22 +259,36 @@ class Content(Resource):
         query = {'id': content_id}
         factory.get_database().get_collection(conflict_col).delete_one(query)
 
+        # Answers to queries might have changed
+        query_cache.invalidate()
+
         if new_document['updatedExisting']:
             return input_data
 
 
 class UnknownQueries(Resource):
     @api.marshal_with(unknown_query_model)
+    @api.expect(page_parser)
+    @api.response(400, 'Invalid limit or cursor')
+    @api.response(503, 'Queued unknown queries could not be written')
     def get(self):
-        unknown_queries = factory.get_collection(unknown_col).find()
+        # Include the queries which are still queued
+        if not unknown_query_log.flush():
+            abort(503, 'Queued unknown queries could not be written')
+        unknown_queries, headers = get_page(unknown_col, ['query_text'])
         unknown_queries = [{'query_text': unknown_query['query_text']}
                            for unknown_query in unknown_queries]
-        return unknown_queries
+        return unknown_queries, 200, headers
 
     @api.marshal_with(delete_model)
     @api.response(200, 'Success', delete_model)
     @api.response(404, 'Document not found')
+    @api.response(503, 'Queued unknown queries could not be written')
     def delete(self, unknown_query):
+        # Write queued queries first, so the query is not logged again after
+        # it is deleted
+        if not unknown_query_log.flush():
+            abort(503, 'Queued unknown queries could not be written')
         result = factory.delete_document({'query_text': unknown_query},
                                          unknown_col)
         if result.deleted_count > 0:
@@ -230,6 +304,9 @@ api.add_resource(HelloWorld,
 api.add_resource(Response,
                  '/response/<string:query>/',
                  methods=['GET'])
+api.add_resource(BatchResponse,
+                 '/responses/',
+                 methods=['POST'])
 api.add_resource(FullResponse,
                  '/response/',
                  methods=['GET'])
@@ -5,9 +5,19 @@ handler = QueryHandler()
 
 
 class DirectResponse(object):
-    def __init__(self, user_input=''):
+    def __init__(self, user_input='', response=None):
         self.user_input = user_input
-        self.response = handler.get_response(self.user_input)
+        self.response = response if response is not None \
+            else handler.get_response(self.user_input)
+
+
+class BatchResponse(object):
+    def __init__(self, user_inputs=None):
+        user_inputs = user_inputs or []
+        responses = handler.get_responses(user_inputs)
+        self.responses = [DirectResponse(user_input, response)
+                          for user_input, response
+                          in zip(user_inputs, responses)]
 
 
 class Response(object):
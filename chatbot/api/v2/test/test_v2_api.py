@@ -36,6 +36,23 @@ def test_response(client):
         factory.delete_document({'unknown_query': query}, conflict_col)
 
 
+def test_batch_response(client):
+    queries = ['some test response', 'another test response']
+    response = client.post('/v2/responses/',
+                           data=json.dumps({'queries': queries}),
+                           content_type='application/json')
+    assert response.status_code == 200
+
+    response_data = json.loads(response.data.decode())['responses']
+    assert [res['user_input'] for res in response_data] == queries
+    assert all(res['response'] for res in response_data)
+
+    response = client.post('/v2/responses/',
+                           data=json.dumps({'queries': 'not a list'}),
+                           content_type='application/json')
+    assert response.status_code == 400
+
+
 def test_get_conflict_ids(client):
     # Setup two conflicts
     conflicts = [{"id": "test_conflict_id_{}".format(i),
@@ -194,6 +211,28 @@ def test_get_unknown_queries(client):
         factory.delete_document(query, unknown_col)
 
 
+def test_get_unknown_queries_page(client):
+    queries = [{'query_text': 'test unknown_query {}'.format(i)}
+               for i in range(2)]
+    for query in queries:
+        factory.post_document(query.copy(), unknown_col)
+
+    try:
+        response = client.get('/v2/unknown_queries/?limit=1')
+        assert len(json.loads(response.data.decode())) == 1
+
+        cursor = response.headers['X-Next-Cursor']
+        response = client.get('/v2/unknown_queries/?limit=1&cursor={}'
+                              .format(cursor))
+        assert len(json.loads(response.data.decode())) == 1
+
+        response = client.get('/v2/unknown_queries/?limit=1&cursor=invalid')
+        assert response.status_code == 400
+    finally:
+        for query in queries:
+            factory.delete_document(query, unknown_col)
+
+
 def test_delete_unknown_query(client):
     query = {'query_text': 'test unknown_query'}
     factory.post_document(query, unknown_col)
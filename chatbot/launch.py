@@ -1,73 +1,199 @@
 import sys
+import time
 
-import pymongo
+from contextlib import contextmanager
 
-from progressbar import ProgressBar
+import pymongo
 
-from chatbot.model.serializer import Serializer
+from chatbot.model.serializer import Serializer, get_content_hash
 from chatbot.model.model_factory import ModelFactory
+from chatbot.nlp.query_cache import bump_data_version
+from chatbot.nlp.search_index import build_search_index, get_corpus_text
+from chatbot.nlp.wordnet_table import build_wordnet_table
+from chatbot.scraper.crawl_state import CrawlStateStore
 from chatbot.util.config_util import Config
 
 
+# The TF-IDF model of the last full refresh, reused by incremental refreshes
+KEYWORD_MODEL_FILE = Config.get_value(["model", "keyword_model_file"])
+
+# The state of the incremental crawls, which is committed once the changed
+# pages are written
+CRAWL_STATE_FILE = Config.get_value(["scraper", "crawl_state_file"])
+
+
 def main():
     if len(sys.argv) > 1:
         filepath = sys.argv[1]
     else:
         raise ValueError("No data-file path provided")
 
-    ser = Serializer(filepath)
-    ser.serialize_data()
-    data = ser.get_models()
-    insert_documents(data)
+    # Only serialize and write the pages which changed since the last
+    # refresh, instead of rebuilding the prod collection
+    if "--incremental" in sys.argv[2:]:
+        known_pages, known_contents = get_known_hashes()
+        ser = Serializer(filepath, known_pages=known_pages,
+                         known_contents=known_contents)
+        # The changed pages are only a part of the corpus, so keywords are
+        # scored with the IDF of the last full refresh
+        ser.load_keyword_model(KEYWORD_MODEL_FILE)
+        data = list(ser.iter_models())
+        update_documents(data, ser.get_changed_pages())
 
+        # The next crawl only requests the written pages conditionally
+        crawl_state = CrawlStateStore(CRAWL_STATE_FILE)
+        crawl_state.commit_staged()
+        crawl_state.close()
+    else:
+        # The models are streamed from the scraped data into the database
+        ser = Serializer(filepath)
+        insert_documents(ser.iter_models())
+        ser.save_keyword_model(KEYWORD_MODEL_FILE)
+
+    corpus = get_corpus()
+    update_search_index(corpus)
+    update_wordnet_table(corpus)
 
-def insert_documents(data):
-    """ Insert all provided documents. Checks if the document has been manually
-    changed before - if it has, and the new document does not match, it is
-    marked as a conflict """
+
+def insert_documents(data,
+                     temp_col=Config.get_mongo_collection("temp_scraped"),
+                     prod_col=Config.get_mongo_collection("prod"),
+                     manual_col=Config.get_mongo_collection("manual"),
+                     conflict_col=Config.get_mongo_collection("conflicts")):
+    """ Insert all provided documents, from any iterable. Checks if the
+    document has been manually changed before - if it has, and the new
+    document does not match, it is marked as a conflict """
     factory = ModelFactory.get_instance()
     factory.set_db()
 
-    temp_col = Config.get_mongo_collection("temp_scraped")
-    manual_col = Config.get_mongo_collection("manual")
-    unknown_col = Config.get_mongo_collection("unknown")
-    prod_col = Config.get_mongo_collection("prod")
-    conflict_col = Config.get_mongo_collection("conflicts")
+    # Build the indexes on an empty temp collection before inserting, so a
+    # duplicate id only fails its own document, and queries never run
+    # against a prod collection without the indexes
+    factory.get_collection(temp_col).drop()
+    with log_time("Index build"):
+        if factory.ensure_indexes(["prod"], collection=temp_col):
+            factory.get_collection(temp_col).drop()
+            raise RuntimeError("Indexes are missing on {}, keeping the "
+                               "current production collection"
+                               .format(temp_col))
 
-    print("Starting insertion of {} documents".format(len(data)))
-    pbar = ProgressBar()
-    for i, doc in enumerate(pbar(data)):
-        factory.post_document(doc, temp_col)
-    print("Successfully inserted {} documents".format(i + 1))
+    print("Starting insertion of documents")
+    with log_time("Insertion"):
+        n_inserted = factory.post_documents(data, temp_col)
+    print("Successfully inserted {} documents".format(n_inserted))
 
-    manual_docs = factory.get_collection(manual_col).find()
+    manual_ids = [doc["id"] for doc in factory.get_collection(manual_col)
+                  .find({"id": {"$exists": True}}, {"id": 1})]
+
+    # Mark corresponding entries in temp collection as manually changed
+    factory.get_collection(temp_col) \
+           .update_many({"id": {"$in": manual_ids}},
+                        {"$set": {"manually_changed": True}})
+
+    # A manually changed document is in conflict if the scraped content has
+    # changed since the document was changed
+    prod_hashes = get_content_hashes(prod_col, manual_ids)
+    temp_hashes = get_content_hashes(temp_col, manual_ids)
 
     conflicts = []
-    for manual_doc in manual_docs:
-        if "id" in manual_doc:
-            idx = manual_doc["id"]
-        else:
-            continue
-
-        # Mark corresponding entry in temp collection as manually changed
-        factory.get_database() \
-               .get_collection(temp_col) \
-               .update_one({"id": idx}, {"$set": {"manually_changed": True}})
-
-        prod_doc = next(factory.get_collection(prod_col).find({"id": idx}),
-                        None)
-        temp_doc = next(factory.get_collection(temp_col).find({"id": idx}),
-                        None)
-
-        if prod_doc and temp_doc:
-            if not temp_doc["content"] == prod_doc["content"]:
-                title = temp_doc["content"]["title"]
+    for idx in manual_ids:
+        if idx in prod_hashes and idx in temp_hashes:
+            if not temp_hashes[idx][0] == prod_hashes[idx][0]:
                 conflicts.append({"id": idx,
-                                  "title": title})
+                                  "title": temp_hashes[idx][1]})
+
+    post_conflicts(conflicts, conflict_col)
+
+    # Update production collection. Renaming with dropTarget replaces prod
+    # in a single step.
+    db = factory.get_database()
+    try:
+        with log_time("Swap"):
+            db.get_collection(temp_col).rename(prod_col, dropTarget=True)
+    except pymongo.errors.OperationFailure as e:
+        db.get_collection(temp_col).drop()
+        raise RuntimeError("Failed to update production db collection: {}"
+                           .format(e))
+
+    # Cached answers refer to the old prod collection. Servers invalidate
+    # their caches when they see the new data version.
+    bump_data_version()
+
+    factory.ensure_indexes(["prod"], collection=prod_col)
+
+    return conflicts
+
+
+def update_documents(data, changed_pages,
+                     prod_col=Config.get_mongo_collection("prod"),
+                     manual_col=Config.get_mongo_collection("manual"),
+                     conflict_col=Config.get_mongo_collection("conflicts")):
+    """ Write the documents of changed pages directly to the prod collection.
+    Contents which were removed from a changed page are deleted, while pages
+    which are missing from the scraped data are left untouched. Checks for
+    conflicts with manually changed documents, like insert_documents """
+    factory = ModelFactory.get_instance()
+    factory.set_db()
+
+    # Contents are replaced by id and removed by url
+    factory.ensure_indexes(["prod"], collection=prod_col)
+
+    manual_ids = set(doc["id"] for doc in factory.get_collection(manual_col)
+                     .find({"id": {"$exists": True}}, {"id": 1}))
+    prod_hashes = get_content_hashes(prod_col,
+                                     [doc["id"] for doc in data
+                                      if doc["id"] in manual_ids])
+
+    conflicts = []
+    requests = []
+    page_ids = {url: list(page["unchanged_ids"])
+                for url, page in changed_pages.items()}
+    for doc in data:
+        idx = doc["id"]
+        page_ids.setdefault(doc["url"], []).append(idx)
+
+        if idx in manual_ids:
+            doc["manually_changed"] = True
+
+            # The content is changed, so a stored document is in conflict
+            if idx in prod_hashes and \
+                    not doc["content_hash"] == prod_hashes[idx][0]:
+                conflicts.append({"id": idx,
+                                  "title": doc["content"]["title"]})
+
+        requests.append(pymongo.ReplaceOne({"id": idx}, doc, upsert=True))
+
+    for url, page in changed_pages.items():
+        # Remove contents which are no longer on the page
+        requests.append(pymongo.DeleteMany({"url": url,
+                                            "id": {"$nin": page_ids[url]}}))
+        requests.append(pymongo.UpdateMany(
+            {"url": url}, {"$set": {"page_hash": page["page_hash"]}}))
+
+    print("Updating {} documents on {} changed pages"
+          .format(len(data), len(changed_pages)))
+    n_failed = factory.write_documents(requests, prod_col)
+
+    # Cached answers might refer to changed documents
+    bump_data_version()
+
+    post_conflicts(conflicts, conflict_col)
+
+    if n_failed:
+        raise RuntimeError("Failed to update {} documents, the changed pages "
+                           "are scraped again by the next crawl"
+                           .format(n_failed))
+
+    return conflicts
+
+
+def post_conflicts(conflicts,
+                   conflict_col=Config.get_mongo_collection("conflicts")):
+    """ Store conflicts between scraped and manually changed documents """
+    factory = ModelFactory.get_instance()
 
     print("Conflicts: {}".format(conflicts))
-    factory.get_collection(conflict_col).create_index([("id", 1)],
-                                                      unique=True)
+    factory.ensure_indexes(["conflicts"], collection=conflict_col)
     for conflict in conflicts:
         try:
             factory.post_document(conflict, conflict_col)
@@ -75,33 +201,90 @@ def insert_documents(data):
             # In case there are dupliacte, unsolved conflicts
             pass
 
-    # Update production collection
-    db = factory.get_database()
-    try:
-        db.get_collection(prod_col).rename("old_prod")
-    except pymongo.errors.OperationFailure:
-        # If the prod collection does not exist
-        pass
 
-    try:
-        db.get_collection(temp_col).rename(prod_col)
-    except Exception as e:
-        print("Failed to update production db collection")
-        print(e)
-        db.get_collection("old_prod").rename(prod_col)
-    finally:
-        db.get_collection("old_prod").drop()
-        db.get_collection(temp_col).drop()
+def get_known_hashes():
+    """ Retrieve the page hashes of the pages and the content hashes of the
+    contents in the prod collection """
+    factory = ModelFactory.get_instance()
+    factory.set_db()
 
-    # Update all indexes
-    factory.set_index(prod_col)
-    factory.set_index(manual_col)
-    factory.set_index(temp_col)
-    # Removes duplicates
-    factory.get_collection(unknown_col).create_index([("query_text", 1)],
-                                                     unique=True)
+    prod_col = Config.get_mongo_collection("prod")
 
-    return conflicts
+    known_pages = {}
+    known_contents = {}
+    for doc in factory.get_collection(prod_col).find(
+            {}, {"id": 1, "url": 1, "page_hash": 1, "content_hash": 1}):
+        if doc.get("page_hash"):
+            known_pages[doc["url"]] = doc["page_hash"]
+        if doc.get("content_hash"):
+            known_contents[doc["id"]] = doc["content_hash"]
+
+    return known_pages, known_contents
+
+
+@contextmanager
+def log_time(phase):
+    """ Log how long the phase inside the with-block takes """
+    start = time.time()
+    yield
+    print("{} took {:.2f} seconds".format(phase, time.time() - start))
+
+
+def get_content_hashes(collection, ids):
+    """ Map the id of each of the given documents in collection to the hash
+    and title of its content. Documents which were stored before content
+    hashes were introduced get their hash computed from the content """
+    factory = ModelFactory.get_instance()
+    col = factory.get_collection(collection)
+
+    hashes = {}
+    for doc in col.find({"id": {"$in": ids},
+                         "content_hash": {"$exists": True}},
+                        {"id": 1, "content_hash": 1, "content.title": 1}):
+        hashes[doc["id"]] = (doc["content_hash"], doc["content"]["title"])
+
+    for doc in col.find({"id": {"$in": ids},
+                         "content_hash": {"$exists": False}},
+                        {"id": 1, "content": 1}):
+        hashes[doc["id"]] = (get_content_hash(doc["content"]),
+                             doc["content"]["title"])
+
+    return hashes
+
+
+def get_corpus():
+    """ Retrieve the corpus texts of all documents in the prod and manual
+    collections """
+    factory = ModelFactory.get_instance()
+    factory.set_db()
+
+    corpus = []
+    for collection in [Config.get_mongo_collection("prod"),
+                       Config.get_mongo_collection("manual")]:
+        docs = factory.get_collection(collection).find({}, {"content": 1})
+        for doc in docs:
+            try:
+                corpus.append(get_corpus_text(doc))
+            except (KeyError, TypeError):
+                # Skip documents which do not follow the model schema
+                continue
+
+    return corpus
+
+
+def update_search_index(corpus):
+    """ Build the search index used to score queries, and persist it to
+    disk """
+    n_docs, n_terms = build_search_index(corpus)
+    print("Built search index of {} documents and {} terms"
+          .format(n_docs, n_terms))
+
+
+def update_wordnet_table(corpus):
+    """ Precompute WordNet synonyms for the vocabulary of the corpus, so
+    that queries do not have to look them up in WordNet """
+    n_records = build_wordnet_table(corpus)
+    print("Built WordNet synonym table of {} lemmas".format(n_records))
 
 
 if __name__ == "__main__":
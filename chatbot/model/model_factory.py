@@ -1,14 +1,58 @@
+import base64
+import binascii
+import itertools
 import os
+import time
 import pymongo
 
-from bson import json_util
+from concurrent.futures import ThreadPoolExecutor
+
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
 
 from chatbot.util.config_util import Config
 
 
+INSERT_BATCH_SIZE = Config.get_value(["mongo", "insert_batch_size"])
+
+# Number of text searches which run concurrently in the background, shared by
+# every thread serving requests
+SEARCH_WORKERS = Config.get_value(["mongo", "search_workers"])
+
+# Text index used to search for documents, on three different keyword fields
+TEXT_INDEX = [("keywords", pymongo.TEXT),
+              ("content.keywords.keyword", pymongo.TEXT),
+              ("header_meta_keywords", pymongo.TEXT)]
+
+# Indexes required by the search and the APIs, as a list of keys and options
+# for each collection in the settings file
+INDEXES = {
+    "prod": [
+        (TEXT_INDEX, {"default_language": "norwegian"}),
+        ([("id", pymongo.ASCENDING)], {"unique": True}),
+        ([("url", pymongo.ASCENDING)], {}),
+    ],
+    "manual": [
+        (TEXT_INDEX, {"default_language": "norwegian"}),
+        ([("id", pymongo.ASCENDING)], {"unique": True}),
+    ],
+    "conflicts": [
+        # The v1 API stores conflicts with a conflict_id instead of an id
+        ([("id", pymongo.ASCENDING)], {"unique": True, "sparse": True}),
+        ([("conflict_id", pymongo.ASCENDING)], {}),
+    ],
+    "unknown": [
+        # Removes duplicates
+        ([("query_text", pymongo.ASCENDING)], {"unique": True}),
+    ],
+}
+
+
 class ModelFactory:
     __instance = None
     __database = None
+    # Used to issue searches on several collections concurrently
+    __executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
 
     @staticmethod
     def get_instance():
@@ -45,37 +89,74 @@ class ModelFactory:
 
         self._set_database(url, db, user, password, port)
 
+    def _text_search(self, collection, search, projection, number_of_docs):
+        """ Run a text search on a collection and return the top scoring
+        documents """
+        cursor = self.get_collection(collection).find(search, projection)
+        # Sort and retrieve some of the top scoring documents.
+        cursor.sort([('score', {'$meta': 'textScore'})]).limit(number_of_docs)
+        return list(cursor)
+
     def get_document(self, query,
                      prod_col=Config.get_mongo_collection("prod"),
                      manual_col=Config.get_mongo_collection("manual"),
-                     number_of_docs=30):
+                     number_of_docs=30,
+                     projection=None):
         """
         Searches for documents using MongoDB in a given document collection.
-        Get 15 results from prod. Get 15 from Manual.
-        Go through every doc in prod and delete the ones with
-        manually_changed=true.  Then return every remaining document, remember
-        it's not sorted now, but for what we need it for this is not necessary.
+        Get 15 results from prod, leaving out the ones with
+        manually_changed=true. Get 15 from Manual. The manual search runs in
+        the background while prod is searched. Then return every document,
+        remember it's not sorted now, but for what we need it for this is not
+        necessary. If a projection is given, only those fields are returned.
         """
-        prod_col = self.get_collection(prod_col)
-        cursor = prod_col.find({'$text': {'$search': query}},
-                               {'score': {'$meta': 'textScore'}})
-        # Sort and retrieve some of the top scoring documents.
-        cursor.sort([('score', {'$meta': 'textScore'})]).limit(number_of_docs)
+        (prod_search, manual_search), fields = \
+            self._get_searches(query, projection)
 
-        docs = []
-        for doc in cursor:
-            if doc["manually_changed"] is False:
-                docs.append(doc)
+        manual_docs = self.__executor.submit(self._text_search, manual_col,
+                                             manual_search, fields,
+                                             number_of_docs)
+        prod_docs = self._text_search(prod_col, prod_search, fields,
+                                      number_of_docs)
 
-        manual_col = self.get_collection(manual_col)
-        cursor = manual_col.find({'$text': {'$search': query}},
-                                 {'score': {'$meta': 'textScore'}})
-        # Sort and retrieve some of the top scoring documents.
-        cursor.sort([('score', {'$meta': 'textScore'})]).limit(number_of_docs)
-        for doc in cursor:
-            docs.append(doc)
+        return prod_docs + manual_docs.result()
 
-        return docs
+    def get_documents(self, queries,
+                      prod_col=Config.get_mongo_collection("prod"),
+                      manual_col=Config.get_mongo_collection("manual"),
+                      number_of_docs=30,
+                      projection=None):
+        """ Searches for the documents of several queries like get_document,
+        issuing all the searches at once. Returns the documents of each
+        query """
+        futures = []
+        for query in queries:
+            (prod_search, manual_search), fields = \
+                self._get_searches(query, projection)
+            futures.append((
+                self.__executor.submit(self._text_search, prod_col,
+                                       prod_search, fields, number_of_docs),
+                self.__executor.submit(self._text_search, manual_col,
+                                       manual_search, fields, number_of_docs),
+            ))
+
+        return [prod_docs.result() + manual_docs.result()
+                for prod_docs, manual_docs in futures]
+
+    @staticmethod
+    def _get_searches(query, projection):
+        """ The text searches on prod and manual for a query, and the fields
+        to retrieve """
+        fields = {'score': {'$meta': 'textScore'}}
+        if projection:
+            fields['_id'] = 0
+            fields.update({field: 1 for field in projection})
+
+        prod_search = {'$text': {'$search': query},
+                       'manually_changed': False}
+        manual_search = {'$text': {'$search': query}}
+
+        return (prod_search, manual_search), fields
 
     def post_document(self, data, collection):
         """ Posts JSON data to colletion in db """
@@ -93,6 +174,81 @@ class ModelFactory:
 
         return response
 
+    def post_documents(self, data, collection, batch_size=INSERT_BATCH_SIZE):
+        """ Posts an iterable of JSON documents to collection in db, using
+        unordered bulk inserts of batch_size documents. Returns the number of
+        inserted documents """
+        col = self.get_collection(collection)
+
+        # Converts the data correctly if not a dict (str)
+        data = (doc if isinstance(doc, dict) else json_util.loads(doc)
+                for doc in data)
+
+        n_inserted = 0
+        start = time.time()
+        while True:
+            batch = list(itertools.islice(data, batch_size))
+            if not batch:
+                break
+
+            try:
+                n_inserted += len(col.insert_many(batch, ordered=False)
+                                     .inserted_ids)
+            except pymongo.errors.BulkWriteError as e:
+                # The rest of the batch is still inserted when some documents
+                # fail, e.g. because of duplicate keys
+                n_inserted += e.details["nInserted"]
+                print("Failed to insert {} documents"
+                      .format(len(e.details["writeErrors"])))
+
+            elapsed = time.time() - start
+            print("Inserted {} documents ({:.0f} documents/s)"
+                  .format(n_inserted, n_inserted / max(elapsed, 1e-6)))
+
+        return n_inserted
+
+    def write_documents(self, requests, collection,
+                        batch_size=INSERT_BATCH_SIZE):
+        """ Runs a list of bulk write operations on collection in unordered
+        batches of batch_size operations. Returns the number of operations
+        which failed """
+        col = self.get_collection(collection)
+
+        n_failed = 0
+        for i in range(0, len(requests), batch_size):
+            try:
+                col.bulk_write(requests[i:i + batch_size], ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                n_failed += len(e.details["writeErrors"])
+                print("Failed {} write operations"
+                      .format(len(e.details["writeErrors"])))
+
+        return n_failed
+
+    def get_page(self, collection, query=None, projection=None, limit=None,
+                 cursor=None):
+        """ Retrieve documents from collection in the order of their _id,
+        with only the fields in projection. If limit is given, at most limit
+        documents following cursor are returned. Returns the documents, and
+        the cursor of the next page, which is None on the last page. Raises
+        ValueError if the cursor is invalid """
+        query = dict(query or {})
+        if cursor:
+            query["_id"] = {"$gt": decode_cursor(cursor)}
+
+        fields = {field: 1 for field in projection} if projection else None
+
+        docs = self.get_collection(collection).find(query, fields) \
+                   .sort("_id", pymongo.ASCENDING)
+        if limit is None:
+            return docs, None
+
+        docs = list(docs.limit(limit))
+        next_cursor = encode_cursor(docs[-1]["_id"]) \
+            if docs and len(docs) == limit else None
+
+        return docs, next_cursor
+
     def update_document(self, query, data, collection):
         """ Updates the document specified in query with the new data """
         col = self.get_collection(collection)
@@ -113,13 +269,80 @@ class ModelFactory:
         """ Create indexing based on three different keyword fields. Set the
         default language to Norwegian to map similar words """
         self.get_collection(collection).create_index(
-                [("keywords", pymongo.TEXT),
-                 ("content.keywords.keyword", pymongo.TEXT),
-                 ("header_meta_keywords", pymongo.TEXT)],
-                default_language="norwegian")
+                TEXT_INDEX, default_language="norwegian")
+
+    def ensure_indexes(self, names=INDEXES.keys(), collection=None):
+        """ Create the indexes declared in INDEXES for the collections with
+        the given names in the settings file. If collection is given, the
+        indexes of the single name are created on that collection instead.
+        Indexes which already exist are left as they are. Returns the indexes
+        which are still missing """
+        missing = {}
+        for name in names:
+            col = collection or Config.get_mongo_collection(name)
+            for keys, options in INDEXES[name]:
+                try:
+                    self.get_collection(col).create_index(keys, **options)
+                except pymongo.errors.PyMongoError as e:
+                    print("Failed to create index {} on {}: {}"
+                          .format(keys, col, e))
+
+            missing.update(self.get_missing_indexes([name], col))
+
+        self.report_missing_indexes(missing)
+        return missing
+
+    def get_missing_indexes(self, names=INDEXES.keys(), collection=None):
+        """ Map each collection to the keys of the indexes declared in
+        INDEXES which do not exist on it """
+        missing = {}
+        for name in names:
+            col = collection or Config.get_mongo_collection(name)
+            try:
+                indexes = self.get_collection(col).index_information()
+            except pymongo.errors.PyMongoError:
+                indexes = {}
+
+            existing = [index["key"] for index in indexes.values()]
+            for keys, _ in INDEXES[name]:
+                if not any(_index_matches(keys, key) for key in existing):
+                    missing.setdefault(col, []).append(keys)
+
+        return missing
+
+    def report_missing_indexes(self, missing):
+        """ Print the indexes returned from get_missing_indexes """
+        if not missing:
+            print("All required indexes exist")
+        for col, indexes in missing.items():
+            for keys in indexes:
+                print("Missing index {} on {}".format(keys, col))
 
     def get_collection(self, collection):
         return self.database[collection]
 
     def get_database(self):
         return self.database
+
+
+def _index_matches(keys, existing_key):
+    """ Check whether the existing index key from index_information matches
+    the declared keys. Text indexes are stored with the special _fts and _ftsx
+    keys in place of the text fields """
+    if any(direction == pymongo.TEXT for _, direction in keys):
+        return ("_fts", "text") in existing_key
+
+    return list(existing_key) == list(keys)
+
+
+def encode_cursor(object_id):
+    """ Opaque pagination cursor pointing after the given _id """
+    return base64.urlsafe_b64encode(object_id.binary).decode()
+
+
+def decode_cursor(cursor):
+    """ Return the _id of a cursor from encode_cursor """
+    try:
+        return ObjectId(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, InvalidId, TypeError):
+        raise ValueError("Invalid cursor")
@@ -1,18 +1,38 @@
+import collections
+import io
+import itertools
 import json
-import copy
+import os
+import pickle
 import urllib.request
 
-from progressbar import ProgressBar
+from hashlib import sha1
 
-from chatbot.nlp.keyword import get_keywords, get_tfidf_model
+from chatbot.nlp.keyword import fit_tfidf_vectorizer, get_keywords_batch
 from chatbot.util.config_util import Config
 
 
+# Number of paragraphs to extract keywords from at a time
+KEYWORD_BATCH_SIZE = Config.get_value(["model", "keyword_batch_size"])
+
+
+def get_page_hash(tree):
+    """ Stable hash of the tree of a scraped page """
+    return sha1(json.dumps(tree, sort_keys=True).encode()).hexdigest()
+
+
+def get_content_hash(content):
+    """ Stable hash of the title and texts of a content. Keywords are left
+    out, since their confidences change whenever the rest of the corpus
+    does """
+    return sha1(json.dumps([content["title"], content["texts"]])
+                .encode()).hexdigest()
+
+
 class KeyWord:
     """ Keyword to fill keyword-list in model schema contents-list """
 
-    __word = None
-    __confidence = None
+    __slots__ = ("__word", "__confidence")
 
     def __init__(self, word, confidence):
         self.__word = word
@@ -25,9 +45,7 @@ class KeyWord:
 class Content:
     """ Content to fill contents-list in model schema """
 
-    __title = ""
-    __keywords = []
-    __texts = []
+    __slots__ = ("__title", "__keywords", "__texts")
 
     def __init__(self, title, texts, keywords=[]):
         self.__title = title
@@ -61,93 +79,214 @@ class Serializer:
         "url": "",
         "header_meta_keywords": [],
         "content": {},
+        "content_hash": "",
+        "page_hash": "",
         "manually_changed": False
     }
-    __models = []
-    __data = []
 
-    def __init__(self, file_name=None, url=None):
+    def __init__(self, file_name=None, url=None, known_pages=None,
+                 known_contents=None):
+        """ known_pages maps the url of each stored page to its page hash, and
+        known_contents maps the id of each stored content to its content
+        hash. Pages and contents which are unchanged since they were stored
+        are skipped when serializing """
         self.file_name = file_name
         self.url = url
-        self.load_data()
-
-        vectorizer, transformed_corpus, feature_names = self.get_tfidf_model()
+        self.known_pages = known_pages or {}
+        self.known_contents = known_contents or {}
+        self.__models = []
 
-        self.__transformed_corpus = transformed_corpus
-        self.__feature_names = feature_names
-        self.__vectorizer = vectorizer
+        # The TF-IDF model is only fitted if some content has changed
+        self.__vectorizer = None
+        self.__feature_names = None
 
-    def load_data(self):
-        """ Load all JSON data from a file and sets self.__data. Mostly used
-        for testing-purposes: real data from scraper is a list of several JSON
-        objects """
+        # Maps the url of each changed page to its page hash and the ids of
+        # its unchanged contents. Only kept when some pages are known, since
+        # every page is changed on a full refresh
+        self.__changed_pages = {}
 
+    def __open(self):
+        """ Open the scraped data from the file or url as text """
         if self.file_name:
-            with open(self.file_name, "r") as f:
-                self.__data.extend(json.load(f))
+            return open(self.file_name, "r", encoding="utf-8")
         elif self.url:
-            with urllib.request.urlopen(self.url) as url:
-                self.__data.extend(json.loads(url.read().decode()))
-
-    def get_data(self):
-        return self.__data
+            return io.TextIOWrapper(urllib.request.urlopen(self.url),
+                                    encoding="utf-8")
+        return io.StringIO("[]")
+
+    def iter_pages(self):
+        """ Generate the pages in the data from the scraper, one at a time.
+        JSON Lines feeds are streamed line by line, while a JSON list has to
+        be loaded at once. Mostly used for testing-purposes: real data from
+        scraper is a JSON Lines feed """
+        with self.__open() as f:
+            # Look at the first character to find the format
+            first = f.read(1)
+            while first.isspace():
+                first = f.read(1)
+
+            if first == "[":
+                yield from json.loads(first + f.read())
+                return
+
+            for line in itertools.chain([first + f.readline()], f):
+                if line.strip():
+                    yield json.loads(line)
 
     def get_models(self):
         return self.__models
 
-    def get_tfidf_model(self):
-        corpus = []
-        for data in self.__data:
-            queue = list(data['tree'].get('children', []))
+    def get_changed_pages(self):
+        return self.__changed_pages
+
+    def iter_corpus(self):
+        """ Generate the text of every node in the scraped pages """
+        for data in self.iter_pages():
+            queue = collections.deque(data['tree'].get('children', []))
             while queue:
-                node = queue.pop(0)
+                node = queue.popleft()
                 if 'text' in node:
-                    corpus.append(node['text'])
+                    yield node['text']
                 if 'children' in node:
-                    queue += node['children']
+                    queue.extend(node['children'])
+
+    def get_tfidf_model(self):
+        """ Fit the TF-IDF model in a separate pass over the scraped data.
+        Returns the vectorizer and its feature names """
+        return fit_tfidf_vectorizer(self.iter_corpus())
+
+    def save_keyword_model(self, path):
+        """ Store the fitted TF-IDF model, so that incremental refreshes
+        score keywords with the IDF of the full corpus. Nothing is stored if
+        the model was not fitted """
+        if self.__vectorizer is None:
+            return
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Replace the stored model at once, so it is never half written
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump((self.__vectorizer, self.__feature_names), f)
+        os.replace(path + ".tmp", path)
+
+    def load_keyword_model(self, path):
+        """ Use the TF-IDF model stored by the last full refresh instead of
+        fitting it on the scraped data """
+        try:
+            with open(path, "rb") as f:
+                self.__vectorizer, self.__feature_names = pickle.load(f)
+        except FileNotFoundError:
+            raise ValueError("No keyword model at {}, run a full refresh "
+                             "first".format(path))
+
+    def __get_keywords(self, documents):
+        """ Extract keywords from a list of documents, fitting the TF-IDF
+        model on the first call """
+        if self.__vectorizer is None:
+            vectorizer, feature_names = self.get_tfidf_model()
+            self.__vectorizer = vectorizer
+            self.__feature_names = feature_names
+
+        return get_keywords_batch(self.__vectorizer, self.__feature_names,
+                                  documents)
+
+    def __add_contents(self, leaves):
+        """ Create the Contents of a list of leaves from collect_leaves,
+        extracting the keywords of all of them at once """
+        keywords = self.__get_keywords(["{} {}".format(title, text)
+                                        for _, title, text in leaves])
+
+        models = []
+        for (model, title, text), leaf_keywords in zip(leaves, keywords):
+            content = Content(title, [text],
+                              [KeyWord(*kw) for kw in leaf_keywords])
+            model["content"] = content.get_content()
+            models.append(model)
+
+        return models
 
-        return get_tfidf_model(corpus)
+    def collect_leaves(self, data, model_template, leaves, title=None,
+                       unchanged_ids=None):
+        """ Recursively traverse the children and collect a new model, the
+        title and the text of each changed paragraph. Paragraphs whose content
+        is unchanged are only added to unchanged_ids. """
+        if unchanged_ids is None:
+            unchanged_ids = []
 
-    def visit_node(self, data, model_template, models, title=None):
-        """ Recursively traverse the children and create new Contents from
-        paragraphs. """
         accepted_tags = Config.get_value(["model", "accepted_tags"])
 
         for child in data:
             if "children" in child:
                 title_text = "{} - {}".format(title, child["text"]) \
                              if title else child["text"]
-                self.visit_node(child["children"], model_template,
-                                models, title=title_text)
+                self.collect_leaves(child["children"], model_template,
+                                    leaves, title=title_text,
+                                    unchanged_ids=unchanged_ids)
 
             elif child["tag"] in accepted_tags:
                 # Hit a leaf node in recursion tree. We extract the text here
                 # and continue.
-                keywords = [KeyWord(*kw)
-                            for kw in get_keywords(self.__vectorizer,
-                                                   self.__feature_names,
-                                                   "{} {}"
-                                                   .format(title,
-                                                           child["text"]))]
-
-                content = Content(title, [child["text"]], keywords)
-                new_model = copy.deepcopy(model_template)
-                new_model["id"] = child["id"]
-                new_model["content"] = content.get_content()
-                models.append(new_model)
+                content_hash = get_content_hash({"title": title,
+                                                 "texts": [child["text"]]})
+
+                # Skip keyword extraction for unchanged paragraphs
+                if self.known_contents.get(child["id"]) == content_hash:
+                    unchanged_ids.append(child["id"])
+                    continue
+
+                # The models of a page only differ in these fields, so the
+                # template is copied shallowly
+                new_model = dict(model_template, id=child["id"],
+                                 content_hash=content_hash)
+                leaves.append((new_model, title, child["text"]))
+
+        return leaves
+
+    def visit_node(self, data, model_template, models, title=None,
+                   unchanged_ids=None):
+        """ Create new Contents from the paragraphs in the children, and add
+        them to models. Paragraphs whose content is unchanged are only added
+        to unchanged_ids. """
+        leaves = self.collect_leaves(data, model_template, [], title=title,
+                                     unchanged_ids=unchanged_ids)
+        if leaves:
+            models += self.__add_contents(leaves)
 
         return models
 
     def serialize_data(self):
+        """ Serialize all pages from the web scraper to the data model schema,
+        and store the models """
+        self.__models += self.iter_models()
+
+    def iter_models(self):
         """ Serialize a page object from the web scraper to the data model
-        schema. """
+        schema, generating the models one page at a time. """
         # Iterate over all pages in the JSON data from scraper
-        print("Serializing {} contents".format(len(self.__data)))
+        n_pages = 0
+        leaves = []
+        for data in self.iter_pages():
+            n_pages += 1
+            if n_pages % 1000 == 0:
+                print("Serialized {} pages".format(n_pages))
+
+            model = dict(self.__MODEL_SCHEMA, url=data["url"],
+                         header_meta_keywords=[])
+
+            # Skip pages which are unchanged since they were stored
+            page_hash = get_page_hash(data["tree"])
+            if self.known_pages.get(data["url"]) == page_hash:
+                continue
+            model["page_hash"] = page_hash
 
-        pbar = ProgressBar()
-        for data in pbar(self.__data):
-            model = copy.deepcopy(self.__MODEL_SCHEMA)
-            model["url"] = data["url"]
+            unchanged_ids = []
+            if self.known_pages:
+                self.__changed_pages[data["url"]] = {
+                    "page_hash": page_hash,
+                    "unchanged_ids": unchanged_ids
+                }
 
             # Actual data in the tree
             if "children" not in data["tree"]:
@@ -164,7 +303,15 @@ class Serializer:
                 # over the rest of the list
                 child_data.pop(0)
 
-            models = self.visit_node(child_data, model, [])
-            self.__models += models
+            self.collect_leaves(child_data, model, leaves,
+                                unchanged_ids=unchanged_ids)
+
+            # Extract the keywords of many paragraphs at once
+            if len(leaves) >= KEYWORD_BATCH_SIZE:
+                yield from self.__add_contents(leaves)
+                leaves = []
+
+        if leaves:
+            yield from self.__add_contents(leaves)
 
-        print("Successfully serialized all contents")
+        print("Successfully serialized {} pages".format(n_pages))
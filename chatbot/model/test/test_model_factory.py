@@ -1,5 +1,6 @@
 import json
 import pymongo
+import pytest
 
 from chatbot.model.model_factory import ModelFactory
 
@@ -41,6 +42,11 @@ def test_get_document():
         assert doc[0]["content"] == data[1]["content"]
 
         assert not fact.get_document("sakfscfdsojimad", prod_col="test")
+
+        # Searching for several queries at once gives the same documents
+        queries = ["emne test", "bra test", "sakfscfdsojimad"]
+        assert fact.get_documents(queries, prod_col="test") == \
+            [fact.get_document(query, prod_col="test") for query in queries]
     finally:
         fact.get_database().drop_collection("test")
 
@@ -60,3 +66,46 @@ def test_update_document():
 
     finally:
         fact.get_database().drop_collection("test")
+
+
+def test_post_documents():
+    data = [{"name": "test{}".format(i)} for i in range(5)]
+    try:
+        assert fact.post_documents(data, "test", batch_size=2) == 5
+        assert fact.get_collection("test").count_documents({}) == 5
+    finally:
+        fact.get_database().drop_collection("test")
+
+
+def test_ensure_indexes():
+    fact.get_database().drop_collection("test")
+
+    try:
+        missing = fact.get_missing_indexes(["prod"], collection="test")
+        assert len(missing["test"]) == 3
+
+        assert not fact.ensure_indexes(["prod"], collection="test")
+        assert not fact.get_missing_indexes(["prod"], collection="test")
+    finally:
+        fact.get_database().drop_collection("test")
+
+
+def test_get_page():
+    data = [{"name": "test{}".format(i)} for i in range(5)]
+    fact.post_documents(data, "test")
+
+    try:
+        names = []
+        cursor = None
+        for expected in [2, 2, 1]:
+            docs, cursor = fact.get_page("test", projection=["name"],
+                                         limit=2, cursor=cursor)
+            assert len(docs) == expected
+            names += [doc["name"] for doc in docs]
+        assert cursor is None
+        assert names == [doc["name"] for doc in data]
+
+        with pytest.raises(ValueError):
+            fact.get_page("test", limit=2, cursor="invalid")
+    finally:
+        fact.get_database().drop_collection("test")
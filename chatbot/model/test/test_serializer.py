@@ -1,7 +1,9 @@
 import pytest
 import json
+import time
 
-from chatbot.model.serializer import KeyWord, Serializer, Content
+from chatbot.model.serializer import KeyWord, Serializer, Content, \
+                                    get_content_hash
 
 
 def test_serialize_data():
@@ -30,6 +32,110 @@ def test_serialize_data():
     )
 
 
+def test_iter_json_lines(tmp_path):
+    # A JSON Lines feed should give the same pages as a JSON list
+    path = "chatbot/model/test/test_data/test_data.json"
+    with open(path, "r") as f:
+        data = json.load(f)
+
+    feed = tmp_path / "test_data.jl"
+    feed.write_text("\n".join(json.dumps(page) for page in data))
+
+    assert list(Serializer(str(feed)).iter_pages()) == data
+    assert list(Serializer(path).iter_pages()) == data
+
+
+def test_serialize_data_at_scale(tmp_path):
+    # Micro-benchmark: serialize many copies of the test data
+    with open("chatbot/model/test/test_data/test_data.json", "r") as f:
+        page = json.dumps(json.load(f)[0])
+
+    n_pages = 500
+    feed = tmp_path / "test_data.jl"
+    with open(str(feed), "w") as f:
+        for i in range(n_pages):
+            # Give every copy its own url and ids
+            f.write(page.replace('"id": "', '"id": "{}-'.format(i))
+                        .replace("https://ntnu.no", "https://ntnu.no/{}"
+                                 .format(i)) + "\n")
+
+    start = time.time()
+    ser = Serializer(str(feed))
+    ser.serialize_data()
+    elapsed = time.time() - start
+
+    print("Serialized {} pages in {:.2f} seconds".format(n_pages, elapsed))
+    assert len(ser.get_models()) == 2 * n_pages
+    assert len(set(model["id"] for model in ser.get_models())) == 2 * n_pages
+
+
+def test_serializers_do_not_share_models():
+    path = "chatbot/model/test/test_data/test_data.json"
+    first = Serializer(path)
+    first.serialize_data()
+    second = Serializer(path)
+    second.serialize_data()
+
+    assert len(first.get_models()) == len(second.get_models())
+    assert first.get_models() is not second.get_models()
+
+
+def test_skip_unchanged_contents():
+    # Paragraphs whose content hash is known are not serialized again
+    children = [{"id": "1", "tag": "p", "text": "Åpent alle dager"},
+                {"id": "2", "tag": "p", "text": "Stengt i julen"}]
+    known_contents = {
+        "1": get_content_hash({"title": "Åpningstider",
+                               "texts": ["Åpent alle dager"]}),
+        "2": get_content_hash({"title": "Åpningstider",
+                               "texts": ["Åpent i julen"]}),
+    }
+    ser = Serializer("chatbot/model/test/test_data/test_data.json",
+                     known_contents=known_contents)
+
+    unchanged_ids = []
+    models = ser.visit_node([{"id": "0", "tag": "h1", "text": "Åpningstider",
+                              "children": children}],
+                            {"id": "", "content": {}}, [],
+                            unchanged_ids=unchanged_ids)
+
+    assert unchanged_ids == ["1"]
+    assert [model["id"] for model in models] == ["2"]
+
+
+def test_reuse_keyword_model(tmp_path):
+    # An incremental refresh scores keywords with the stored model
+    path = "chatbot/model/test/test_data/test_data.json"
+    model_file = str(tmp_path / "keyword_model.pkl")
+
+    with pytest.raises(ValueError):
+        Serializer(path).load_keyword_model(model_file)
+
+    full = Serializer(path)
+    full.serialize_data()
+    full.save_keyword_model(model_file)
+
+    incremental = Serializer(path)
+    incremental.load_keyword_model(model_file)
+    incremental.serialize_data()
+
+    def get_keywords(ser):
+        return [model["content"]["keywords"] for model in ser.get_models()]
+
+    assert get_keywords(incremental) == get_keywords(full)
+
+
+def test_content_hash():
+    content = {"title": "Åpningstider", "keywords": [],
+               "texts": ["Svømmehallen er åpen alle dager"]}
+    changed_keywords = dict(content, keywords=[{"keyword": "svømme",
+                                                "confidence": 0.5}])
+    changed_texts = dict(content, texts=["Svømmehallen er stengt"])
+
+    assert get_content_hash(content) == get_content_hash(changed_keywords)
+    assert get_content_hash(content) != get_content_hash(changed_texts)
+
+
 def test_instance_of_KeyWord():
     keyWs = [
         KeyWord("svømme", 0.74),
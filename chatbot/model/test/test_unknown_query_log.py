@@ -0,0 +1,71 @@
+import threading
+
+from chatbot.model.model_factory import ModelFactory
+from chatbot.model.unknown_query_log import UnknownQueryLog
+from chatbot.util.config_util import Config
+
+fact = ModelFactory.get_instance()
+fact.set_db()
+
+
+def test_log_unknown_queries():
+    unknown_col = Config.get_mongo_collection("unknown")
+    query = {"query_text": "test unknown query log"}
+    log = UnknownQueryLog.get_instance()
+
+    try:
+        for _ in range(3):
+            log.log(query["query_text"])
+        assert log.flush()
+
+        doc = fact.get_collection(unknown_col).find_one(query)
+        assert doc["hits"] == 3
+        assert doc["last_seen"]
+    finally:
+        fact.delete_document(query, unknown_col)
+
+
+def test_flush_while_logging():
+    unknown_col = Config.get_mongo_collection("unknown")
+    query = {"query_text": "test unknown query log while flushing"}
+    log = UnknownQueryLog.get_instance()
+    stop = threading.Event()
+
+    def keep_logging():
+        while not stop.is_set():
+            log.log(query["query_text"])
+
+    logger = threading.Thread(target=keep_logging)
+    logger.start()
+
+    try:
+        # The flush must return even though new queries keep arriving
+        flusher = threading.Thread(target=log.flush)
+        flusher.start()
+        flusher.join(timeout=30)
+        assert not flusher.is_alive()
+    finally:
+        stop.set()
+        logger.join()
+        log.flush()
+        fact.delete_document(query, unknown_col)
+
+
+def test_worker_survives_errors():
+    unknown_col = Config.get_mongo_collection("unknown")
+    query = {"query_text": "test unknown query log after error"}
+    log = UnknownQueryLog.get_instance()
+
+    try:
+        # A query which can not be encoded fails its batch, and the worker
+        # keeps writing the next ones
+        log.log(object())
+        assert log.flush()
+
+        log.log(query["query_text"])
+        assert log.flush()
+
+        doc = fact.get_collection(unknown_col).find_one(query)
+        assert doc["hits"] == 1
+    finally:
+        fact.delete_document(query, unknown_col)
@@ -0,0 +1,136 @@
+import atexit
+import collections
+import datetime
+import queue
+import threading
+
+import pymongo
+
+from chatbot.model.model_factory import ModelFactory
+from chatbot.util.config_util import Config
+
+
+BATCH_SIZE = Config.get_value(["mongo", "unknown_batch_size"])
+FLUSH_INTERVAL = Config.get_value(["mongo", "unknown_flush_interval"])
+FLUSH_TIMEOUT = Config.get_value(["mongo", "unknown_flush_timeout"])
+
+
+class UnknownQueryLog:
+    """ Logs queries which could not be answered to the unknown collection.
+    Queries are put on a queue and written in batches by a background
+    worker, so logging a query does not wait for the database. Each unknown
+    query is stored once, with the number of hits and when it was last
+    seen """
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        """ Static access method. """
+        if UnknownQueryLog.__instance is None:
+            UnknownQueryLog()
+        return UnknownQueryLog.__instance
+
+    def __init__(self):
+        """ Virtually private constructor. """
+        if UnknownQueryLog.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            self.__queue = queue.Queue()
+            self.__worker = None
+            self.__lock = threading.Lock()
+            # Write the queries which are still queued when the process exits
+            atexit.register(self.flush)
+            UnknownQueryLog.__instance = self
+
+    def log(self, query_text):
+        """ Queue an unknown query to be written """
+        self.__start_worker()
+        self.__queue.put((query_text, datetime.datetime.utcnow()))
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """ Write all queries which were queued before the flush. Queries
+        which are logged while flushing are not waited for. Returns False if
+        the queries were not written within timeout seconds """
+        self.__start_worker()
+
+        # The worker writes everything queued before the event, then sets it
+        flushed = threading.Event()
+        self.__queue.put(flushed)
+        if not flushed.wait(timeout):
+            print("Timed out flushing unknown queries")
+            return False
+
+        return True
+
+    def __start_worker(self):
+        """ Start the background worker on the first logged query """
+        with self.__lock:
+            if self.__worker is None or not self.__worker.is_alive():
+                self.__worker = threading.Thread(target=self.__run,
+                                                 daemon=True)
+                self.__worker.start()
+
+    def __run(self):
+        """ Write the queued queries in batches, at least every
+        FLUSH_INTERVAL seconds. A batch is written right away when a flush
+        event is reached """
+        while True:
+            flushed = None
+            try:
+                # Wait for a query, and give the batch time to fill up
+                item = self.__queue.get()
+                deadline = datetime.datetime.utcnow() + \
+                    datetime.timedelta(seconds=FLUSH_INTERVAL)
+
+                batch = []
+                while True:
+                    if isinstance(item, threading.Event):
+                        flushed = item
+                        break
+
+                    batch.append(item)
+                    if len(batch) >= BATCH_SIZE:
+                        break
+
+                    timeout = (deadline - datetime.datetime.utcnow()) \
+                        .total_seconds()
+                    try:
+                        item = self.__queue.get(timeout=max(timeout, 0))
+                    except queue.Empty:
+                        break
+
+                self.__write(batch)
+            except Exception as e:
+                # Keep the worker running, so that the queue is still drained
+                print("Failed to write unknown queries")
+                print(e)
+            finally:
+                if flushed is not None:
+                    flushed.set()
+
+    def __write(self, batch):
+        """ Upsert a batch of queries, counting repeated queries once per
+        occurrence """
+        if not batch:
+            return
+
+        hits = collections.Counter(query_text for query_text, _ in batch)
+        last_seen = {}
+        for query_text, seen in batch:
+            last_seen[query_text] = max(seen,
+                                        last_seen.get(query_text, seen))
+
+        requests = [pymongo.UpdateOne({"query_text": query_text},
+                                      {"$inc": {"hits": count},
+                                       "$set": {"last_seen":
+                                                last_seen[query_text]}},
+                                      upsert=True)
+                    for query_text, count in hits.items()]
+
+        try:
+            factory = ModelFactory.get_instance()
+            unknown_col = Config.get_mongo_collection("unknown")
+            factory.write_documents(requests, unknown_col)
+        except pymongo.errors.PyMongoError as e:
+            print("Failed to log {} unknown queries".format(len(hits)))
+            print(e)
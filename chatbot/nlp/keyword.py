@@ -1,7 +1,10 @@
 import collections
+import functools
 import string
 import re
 
+import numpy as np
+
 import spacy
 from spacy.lemmatizer import Lemmatizer
 from spacy.lang.nb import LEMMA_INDEX, LEMMA_EXC, LEMMA_RULES
@@ -10,11 +13,23 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 
 import nltk
 
+from chatbot.util.config_util import Config
+
 
 # Load a Norwegian language model for Spacy.
 nb = spacy.load('nb_dep_ud_sm')
 
-lemmatize = Lemmatizer(LEMMA_INDEX, LEMMA_EXC, LEMMA_RULES)
+# Only tokens and their POS tags are used, so the dependency parser and the
+# entity recognizer are not run.
+DISABLED_PIPES = ['parser', 'ner']
+
+# Batching when streaming many documents through Spacy.
+PIPE_BATCH_SIZE = Config.get_value(['nlp', 'pipe_batch_size'])
+PIPE_THREADS = Config.get_value(['nlp', 'pipe_threads'])
+
+_lemmatizer = Lemmatizer(LEMMA_INDEX, LEMMA_EXC, LEMMA_RULES)
+
+LEMMA_CACHE_SIZE = Config.get_value(['nlp', 'lemma_cache_size'])
 
 nltk.download('wordnet', quiet=True)
 nltk.download('omw', quiet=True)
@@ -26,22 +41,35 @@ END_SPEC_CHARS = re.compile('[{}]+$'.format(re.escape(string.punctuation)))
 def get_stopwords():
     ''' Retrieves stopwords from the stopwords file. '''
     with open('chatbot/nlp/statics/stopwords.txt') as stopwords:
-        return [line.strip() for line in stopwords.readlines() if line.strip()]
+        return frozenset(line.strip() for line in stopwords if line.strip())
 
 
 # Load the stopwords once when the file is loaded.
 stop_words = get_stopwords()
 
 
-def _sort_coo(coo_matrix):
-    ''' Sort scores given in a sparse matrix of coordinates. '''
-    tuples = zip(coo_matrix.col, coo_matrix.data)
-    return sorted(tuples, key=lambda x: (x[1], x[0]), reverse=True)
+def stopwords_file_updated():
+    ''' Updates the cached stopwords whenever the stopwords file is
+    updated. '''
+    global stop_words
+    stop_words = get_stopwords()
+
+
+def is_stopword(token):
+    ''' Returns true if the given token is a stopword. '''
+    return token in stop_words
+
+
+@functools.lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatize(word, pos):
+    ''' Returns the possible lemmas of a word with the given POS tag. The same
+    words repeat a lot across pages, so lemmas are cached for the process. '''
+    return tuple(_lemmatizer(word, pos))
 
 
-def _extract_top(feature_names, sorted_items, n=10):
-    ''' Extracts the top scoring keywords from a sorted list of scores. '''
-    return [(feature_names[i], score) for i, score in sorted_items[:n]]
+def get_lemma_cache_info():
+    ''' Hits, misses and size of the lemma cache. '''
+    return lemmatize.cache_info()
 
 
 def _has_digits(token):
@@ -49,10 +77,22 @@ def _has_digits(token):
     return any(char.isdigit() for char in token)
 
 
-def tokenize(doc):
-    ''' Tokenize a given document. '''
-    # Tokenize the document.
-    tokens = [lemmatize(token.text, token.pos_)[0] for token in nb(doc)]
+def tag(doc):
+    ''' Tokenize and POS tag a single document. '''
+    return nb(doc, disable=DISABLED_PIPES)
+
+
+def tag_all(docs):
+    ''' Tokenize and POS tag many documents, streaming them through Spacy in
+    batches. Returns a generator. '''
+    return nb.pipe(docs, batch_size=PIPE_BATCH_SIZE, n_threads=PIPE_THREADS,
+                   disable=DISABLED_PIPES)
+
+
+def _filter_tokens(tagged_doc):
+    ''' Lemmatize and filter the tokens of a tagged document. '''
+    # Lemmatize the tokens.
+    tokens = [lemmatize(token.text, token.pos_)[0] for token in tagged_doc]
 
     # Remove punctuation tokens.
     tokens = [token for token in tokens if token not in string.punctuation]
@@ -76,11 +116,32 @@ def tokenize(doc):
     return tokens
 
 
+def tokenize(doc):
+    ''' Tokenize a given document. '''
+    return _filter_tokens(tag(doc))
+
+
+def tokenize_all(docs):
+    ''' Tokenize many documents in batches. Returns a generator. '''
+    for tagged_doc in tag_all(docs):
+        yield _filter_tokens(tagged_doc)
+
+
+def _analyze(doc):
+    ''' Analyzer used by the TF-IDF vectorizer. Documents can be given
+    already tokenized, so that a whole corpus is tokenized in batches. '''
+    if isinstance(doc, list):
+        return doc
+
+    # The default analyzer lowercases documents before tokenizing them.
+    return tokenize(doc.lower())
+
+
 def lemmatize_content_keywords(content):
     ''' Go through a content in the format given to the API, and lemmatize
     all keywords again in case something changed. '''
     # Merge all texts and titles, then tokenize and POS tag them.
-    tokens = nb(' '.join(([content['title']] + content['texts'])))
+    tokens = tag(' '.join(([content['title']] + content['texts'])))
 
     # Counter for number of times each POS tag occurs for tokens.
     votes = collections.defaultdict(lambda: collections.Counter())
@@ -89,15 +150,23 @@ def lemmatize_content_keywords(content):
         # For each word, we count how many times each POS tag occurs.
         votes[token.text][token.pos_] += 1
 
+    # Keywords which are not in the document are tagged on their own, using
+    # Spacy as an unigram tagger. Tag all of them in one batch.
+    untagged = [entry['keyword'] for entry in content['keywords']
+                if entry['keyword'] and entry['keyword'] not in votes]
+    unigram_tags = {keyword: tagged[0].pos_ if len(tagged) else ''
+                    for keyword, tagged in zip(untagged, tag_all(untagged))}
+
     for entry in content['keywords']:
         # Verify that the keyword is not empty.
         if not entry['keyword']:
             continue
 
         # Find the most likely POS tag for the keyword.
-        # If the keyword is not in the document, use an unigram tagger.
-        pos = next(iter(votes[entry['keyword']].most_common()),
-                   nb(entry['keyword'])[0].pos_)
+        if entry['keyword'] in votes:
+            pos = votes[entry['keyword']].most_common(1)[0][0]
+        else:
+            pos = unigram_tags[entry['keyword']]
 
         # Store the lemmatized keyword.
         entry['keyword'] = lemmatize(entry['keyword'], pos)[0]
@@ -108,10 +177,12 @@ def get_tfidf_model(corpus):
     using cosine similarity as well as keyword generation. '''
     # Create a vectorizer which will turn documents into vectors.
     # We use a custom list of stopwords and a custom tokenizer.
-    vectorizer = TfidfVectorizer(tokenizer=tokenize, sublinear_tf=True)
+    vectorizer = TfidfVectorizer(analyzer=_analyze, sublinear_tf=True)
 
-    # Create a simple index on the corpus.
-    corpus_matrix = vectorizer.fit_transform(corpus)
+    # Create a simple index on the corpus. The corpus is tokenized in
+    # batches while it is consumed, so it may be a generator.
+    corpus_matrix = vectorizer.fit_transform(
+        tokenize_all(doc.lower() for doc in corpus))
 
     # Retrieve the names of the features. Need this to find which
     # feature a score in the matrix actually belongs to.
@@ -120,11 +191,43 @@ def get_tfidf_model(corpus):
     return vectorizer, corpus_matrix, feature_names
 
 
+def fit_tfidf_vectorizer(corpus):
+    ''' Fit a TF-IDF vectorizer like get_tfidf_model, without returning the
+    matrix of the corpus. The term counts of the corpus are still built while
+    fitting, but the TF-IDF matrix is not. Used when only keywords are
+    generated. '''
+    vectorizer = TfidfVectorizer(analyzer=_analyze, sublinear_tf=True)
+    vectorizer.fit(tokenize_all(doc.lower() for doc in corpus))
+
+    return vectorizer, vectorizer.get_feature_names()
+
+
 def get_keywords(vectorizer, feature_names, document):
     ''' Returns the top keywords and their scores for a given document. '''
-    tfidf_vector = vectorizer.transform([document])
-    sorted_items = _sort_coo(tfidf_vector.tocoo())
+    return get_keywords_batch(vectorizer, feature_names, [document])[0]
+
+
+def get_keywords_batch(vectorizer, feature_names, documents, n=None):
+    ''' Returns the top n keywords and their scores for each of the given
+    documents, or all of them if n is None. The documents are tokenized and
+    transformed together, and the keywords are ordered like get_keywords. '''
+    tfidf_matrix = vectorizer.transform(
+        list(tokenize_all(document.lower() for document in documents))).tocsr()
+
+    keywords = []
+    for row in range(tfidf_matrix.shape[0]):
+        start, end = tfidf_matrix.indptr[row], tfidf_matrix.indptr[row + 1]
+        cols = tfidf_matrix.indices[start:end]
+        scores = tfidf_matrix.data[start:end]
+
+        # Only sort the n highest scores, and the scores which tie with them.
+        if n is not None and n < len(scores):
+            threshold = scores[np.argpartition(-scores, n - 1)[n - 1]]
+            top = scores >= threshold
+            cols, scores = cols[top], scores[top]
+
+        # Sort on score, then column, in descending order.
+        order = np.lexsort((-cols, -scores))[:n]
+        keywords.append([(feature_names[cols[i]], scores[i]) for i in order])
 
-    return _extract_top(feature_names,
-                        sorted_items,
-                        len(sorted_items))
+    return keywords
@@ -1,17 +1,19 @@
+import collections
 import string
 import random
 import os
-import pymongo
 
 from sklearn.metrics.pairwise import cosine_similarity
 
-from spellchecker import SpellChecker
-
-from nltk.corpus import wordnet as wn
-
 from chatbot.model.model_factory import ModelFactory
-from chatbot.nlp.keyword import get_tfidf_model, get_stopwords, lemmatize, nb
+from chatbot.model.unknown_query_log import UnknownQueryLog
+from chatbot.nlp.keyword import get_tfidf_model, is_stopword, lemmatize
+from chatbot.nlp.keyword import tag, tag_all
+from chatbot.nlp.query_cache import QueryCache
+from chatbot.nlp.search_index import SearchIndex, get_corpus_text
+from chatbot.nlp.spelling import SpellingCorrector
 from chatbot.nlp.synset import SynsetWrapper
+from chatbot.nlp.wordnet_table import WORDNET_POS, WordNetTable
 from chatbot.util.config_util import Config
 
 
@@ -20,37 +22,49 @@ MULTIPLE_ANSWERS = Config.get_value(['query_system', 'multiple_answers'])
 CHAR_LIMIT = Config.get_value(['query_system', 'character_limit'])
 MAX_ANSWERS = Config.get_value(['query_system', 'max_answers'])
 URL_FROM_TEXT = Config.get_value(['query_system', 'url_from_text'])
+BATCH_SIZE = Config.get_value(['query_system', 'batch_size'])
+
+# The only fields of the documents which are needed to answer a query.
+DOCUMENT_FIELDS = ['id', 'url', 'content']
 
 
 factory = ModelFactory.get_instance()
 factory.set_db()
 
+# Load the precomputed search index and synonym table when the server starts.
+search_index = SearchIndex.get_instance()
+wordnet_table = WordNetTable.get_instance()
+
+# Ranked results of recent queries.
+query_cache = QueryCache.get_instance()
+
+# Queries which could not be answered are written in the background.
+unknown_query_log = UnknownQueryLog.get_instance()
+
+
+def _refresh_data():
+    ''' Pick up a new search index and synonym table if the data has been
+    refreshed since they were loaded. Cached results are outdated as soon as
+    the launcher has changed the prod collection, and again when the new
+    index and table are loaded. '''
+    data_changed = query_cache.invalidate_if_changed()
+    index_reloaded = search_index.reload_if_changed()
+    table_reloaded = wordnet_table.reload_if_changed()
+
+    if (index_reloaded or table_reloaded) and not data_changed:
+        query_cache.invalidate()
+
 
 def _handle_not_found(query_text):
     '''
-    Inserts this specific query text into the unknown queries collection as
-    well as returning a fallback string.
+    Queues this specific query text to be logged in the unknown queries
+    collection, and returns a fallback string.
     '''
-    try:
-        unknown_col = Config.get_mongo_collection("unknown")
-        factory.get_database().get_collection(unknown_col).insert_one(
-            {"query_text": query_text})
-    except pymongo.errors.DuplicateKeyError:
-        # If we already have this specific query in the unknown_queries
-        # collection we don't need to add it again.
-        pass
+    unknown_query_log.log(query_text)
 
     return NOT_FOUND
 
 
-def _get_corpus_text(doc):
-    ''' Converts a document from the model into a string which will be used in
-    a corpus.  All possible answers are used to generate the corpus, if
-    multiple answers exist.'''
-    content = ' '.join(doc['content']['texts'])
-    return doc['content']['title'] + ' ' + content
-
-
 def _get_answer_text(doc):
     ''' Converts a document from the model into a readable string. '''
     content = random.choice(doc['content']['texts'])
@@ -63,12 +77,23 @@ def expand_query(query):
     ''' Attempts to expand the given query by using synonyms from WordNet. As
     a consequnece of this process, the query is also tokenized and lemmatized.
     '''
-    spell = SpellChecker(local_dictionary='chatbot/nlp/statics/no_50k.json')
+    return _expand_doc(tag(query))
+
+
+def expand_queries(queries):
+    ''' Expands several queries, tagging all of them in a single pass through
+    Spacy. '''
+    return [_expand_doc(doc) for doc in tag_all(queries)]
+
 
-    # Tokenize, tag and filter query using Spacy
+def _expand_doc(doc):
+    ''' Expands a query which has already been tokenized and tagged. '''
+    spell = SpellingCorrector.get_instance()
+
+    # Filter the tokenized and tagged query
     tokens = [
         # Store both token text and POS tag
-        (token.text, token.pos_) for token in nb(query)
+        (token.text, token.pos_) for token in doc
         # Filter away punctuation.
         if token.text not in string.punctuation
     ]
@@ -76,21 +101,20 @@ def expand_query(query):
     # Add possible spelling corrections, without duplicates
     # We also want to keep the original token, since the detected misspelling
     # migt be intentional - power to the user!
+    corrections = [(spell.correction(token[0]), token[1]) for token in tokens]
     tokens += [
-        (spell.correction(token[0]), token[1]) for token in tokens
-        if not spell.correction(token[0]) in [
-            token[0] for token in tokens
-        ]
+        correction for correction in corrections
+        if correction[0] not in [token[0] for token in tokens]
     ]
 
     # Lemmatize tokens
     tokens = [
       # Store tuples of lemmatized tokens and their corresponding POS tags.
-      (lemmatize(token[0], token[1])[0], token[0]) for token in tokens
+      (lemmatize(token[0], token[1])[0], token[1]) for token in tokens
     ]
 
     # Filter away stopwords as we do not want to expand them.
-    tokens = [token for token in tokens if token not in get_stopwords()]
+    tokens = [token for token in tokens if not is_stopword(token[0])]
 
     # Store synonyms in a set, so duplicates are not added multiple times.
     synonyms = set()
@@ -100,10 +124,11 @@ def expand_query(query):
 
     for token in tokens:
         # Convert POS tags from Spacy to WordNet.
-        pos = getattr(wn, token[1], None)
+        pos = WORDNET_POS.get(token[1])
 
-        # Find all synsets for the word, using the Norwegian language.
-        synsets = wn.synsets(token[0], lang='nob', pos=pos)
+        # Find all WordNet synonyms for the word, using the Norwegian
+        # language.
+        wordnet_synonyms = wordnet_table.get_synonyms(token[0], pos)
 
         # Get a custom synset wrapper.
         custom_synsets = SynsetWrapper.get_instance()
@@ -112,16 +137,11 @@ def expand_query(query):
         custom_synset = custom_synsets.get_synset(token[0])
 
         if custom_synset:
-            # Remove the token itself to avoid duplication.
-            custom_synset.remove(token[0])
-            synonyms.update(custom_synset)
+            # Leave out the token itself to avoid duplication.
+            synonyms.update(custom_synset - {token[0]})
 
-        if synsets:
-            for synset in synsets:
-                # Find all lemmas in the synset.
-                for name in synset.lemma_names(lang='nob'):
-                    # Some lemmas contain underscores, which we remove.
-                    synonyms.add(name.replace('_', ' '))
+        if wordnet_synonyms:
+            synonyms.update(wordnet_synonyms)
 
             # If we found synonyms, we only add the synonyms. This is because
             # the original word is already included in the synset, so this
@@ -137,9 +157,103 @@ def expand_query(query):
     return ' '.join(result)
 
 
-def _perform_search(query_text):
-    ''' Takes a query string and finds the best matching document in the
-    database. '''
+def _score_documents(query, docs):
+    ''' Compare the search query with all documents using cosine similarity.
+    The precomputed search index is used when it has been built, otherwise a
+    model is fitted on the retrieved documents. '''
+    # Create a corpus on the results from the MongoDB query.
+    corpus = [get_corpus_text(doc) for doc in docs]
+
+    if search_index.is_loaded():
+        return search_index.score(query, corpus).tolist()
+
+    # Create a TF-IDF model on the corpus.
+    vectorizer, corpus_matrix, feature_names = get_tfidf_model(corpus)
+
+    return cosine_similarity(vectorizer.transform([query]),
+                             corpus_matrix)[0].tolist()
+
+
+def _score_documents_batch(queries, docs_lists):
+    ''' Scores the retrieved documents of several queries. With the search
+    index, all queries and documents are vectorized once and compared in a
+    single sparse product. Queries which can not be scored get None. '''
+    if not search_index.is_loaded():
+        scores = []
+        for query, docs in zip(queries, docs_lists):
+            try:
+                scores.append(_score_documents(query, docs) if docs else None)
+            except ValueError:
+                scores.append(None)
+        return scores
+
+    corpora = [[get_corpus_text(doc) for doc in docs] for docs in docs_lists]
+
+    # Every distinct document text is only vectorized once.
+    texts = list(collections.OrderedDict.fromkeys(
+        text for corpus in corpora for text in corpus))
+    if not texts:
+        return [None] * len(queries)
+
+    columns = {text: column for column, text in enumerate(texts)}
+    score_matrix = search_index.score_batch(queries, texts)
+
+    return [
+        score_matrix[row, [columns[text] for text in corpus]]
+        .toarray().ravel().tolist() if corpus else None
+        for row, corpus in enumerate(corpora)
+    ]
+
+
+def _get_response(query_text, docs, scores):
+    ''' Composes the answer to a query from the retrieved documents and
+    their similarity to the query. '''
+    # Nothing was found, or the documents could not be scored.
+    if not docs or not scores:
+        return _handle_not_found(query_text)
+
+    sorted_scores = sorted(scores, reverse=True)
+
+    # This could be calculated using the mean of all scores and the
+    # standard deviation.
+    if sorted_scores[0] < 0.05:
+        return _handle_not_found(query_text)
+
+    # Allow returning multiple answers if they rank very similarly.
+    answers = []
+
+    for score in sorted_scores:
+        # Tolerance for similarity between scores.
+        if sorted_scores[0] - score > 0.1:
+            break
+
+        # Add this result to the list of answers.
+        answers.append(_get_answer_text(docs[scores.index(score)]))
+
+    if len(answers) == 1:
+        # Return the answer straight away if there is only 1 result/
+        return answers[0]
+
+    # Append answers until we reach the CHAR_LIMIT
+    i, n_chars = 0, 0
+    while n_chars < CHAR_LIMIT and i < len(answers):
+        n_chars += len(answers[i])
+        i += 1
+
+    # If we only have 1 answer after threshold we don't want to add the
+    # MULTI_ANSWERS option to the response
+    if max(i, 1) == 1:
+        return answers[0]
+
+    # Join the results with a separator. Still setting a max number of
+    # answers
+    return '\n\n---\n\n'.join([MULTIPLE_ANSWERS] + answers[0:min(max(i, 1),
+                              MAX_ANSWERS)])
+
+
+def _search(query_text):
+    ''' Takes a query string and ranks the documents in the database by
+    their similarity to it. Returns the documents and their scores. '''
 
     # Perform simple query expansion on the original query.
     query = expand_query(query_text)
@@ -149,67 +263,97 @@ def _perform_search(query_text):
 
     # Retrieve a set of documents using MongoDB. We then attempt to filter
     # these further.
-    docs = factory.get_document(query)
+    docs = factory.get_document(query, projection=DOCUMENT_FIELDS)
 
     # Prevent generating an empty corpus if no documents were found.
     if not docs:
-        return _handle_not_found(query_text)
+        return docs, None
 
-    # Create a corpus on the results from the MongoDB query.
-    corpus = [_get_corpus_text(doc) for doc in docs]
+    try:
+        # Compare the search query with all documents.
+        return docs, _score_documents(query, docs)
+    except KeyError:
+        raise Exception('Document does not have content and texts.')
+    except ValueError:
+        return docs, None
 
-    # Create a TF-IDF model on the corpus.
-    vectorizer, corpus_matrix, feature_names = get_tfidf_model(corpus)
+
+def _search_batch(query_texts):
+    ''' Ranks the documents in the database for several query strings at
+    once. Returns the documents and their scores for each query. '''
+
+    # Expand all queries in one pass.
+    queries = expand_queries(query_texts)
+
+    if str(os.getenv('LOG')) == 'TRUE':
+        for query in queries:
+            print('Post expansion: ', query)
+
+    # Retrieve documents only once for queries which expand equally, and
+    # issue the searches of all of them at once.
+    unique_queries = list(set(queries))
+    results = dict(zip(unique_queries,
+                       factory.get_documents(unique_queries,
+                                             projection=DOCUMENT_FIELDS)))
+    docs_lists = [results[query] for query in queries]
 
     try:
-        # Compare the search query with all documents in our new model using
-        # cosine similarity.
-        scores = cosine_similarity(vectorizer.transform([query]),
-                                   corpus_matrix)[0].tolist()
-
-        sorted_scores = sorted(scores, reverse=True)
-
-        # This could be calculated using the mean of all scores and the
-        # standard deviation.
-        if sorted_scores[0] < 0.05:
-            return _handle_not_found(query_text)
-
-        # Allow returning multiple answers if they rank very similarly.
-        answers = []
-
-        for score in sorted_scores:
-            # Tolerance for similarity between scores.
-            if sorted_scores[0] - score > 0.1:
-                break
-
-            # Add this result to the list of answers.
-            answers.append(_get_answer_text(docs[scores.index(score)]))
-
-        if len(answers) == 1:
-            # Return the answer straight away if there is only 1 result/
-            return answers[0]
-
-        # Append answers until we reach the CHAR_LIMIT
-        i, n_chars = 0, 0
-        while n_chars < CHAR_LIMIT and i < len(answers):
-            n_chars += len(answers[i])
-            i += 1
-
-        # If we only have 1 answer after threshold we don't want to add the
-        # MULTI_ANSWERS option to the response
-        if max(i, 1) == 1:
-            return answers[0]
-
-        # Join the results with a separator. Still setting a max number of
-        # answers
-        return '\n\n---\n\n'.join([MULTIPLE_ANSWERS] + answers[0:min(max(i, 1),
-                                  MAX_ANSWERS)])
+        scores = _score_documents_batch(queries, docs_lists)
+    except KeyError:
+        raise Exception('Document does not have content and texts.')
+
+    return list(zip(docs_lists, scores))
+
+
+def _perform_search(query_text):
+    ''' Takes a query string and finds the best matching document in the
+    database. '''
+    _refresh_data()
+
+    # The ranked documents are cached rather than the answer, so that the
+    # answer text is still picked at random.
+    result = query_cache.get(query_text)
+    if result is None:
+        result = _search(query_text)
+        query_cache.set(query_text, result)
+
+    try:
+        return _get_response(query_text, *result)
+    except KeyError:
+        raise Exception('Document does not have content and texts.')
+
+
+def _perform_batch_search(query_texts):
+    ''' Takes a list of query strings and finds the best matching document
+    for each of them. '''
+    _refresh_data()
+
+    results = [query_cache.get(query_text) for query_text in query_texts]
+
+    # Only search for the queries which are not cached.
+    uncached = [query_text for query_text, result
+                in zip(query_texts, results) if result is None]
+    if uncached:
+        searched = iter(_search_batch(uncached))
+        for i, query_text in enumerate(query_texts):
+            if results[i] is None:
+                results[i] = next(searched)
+                query_cache.set(query_text, results[i])
+
+    try:
+        return [_get_response(query_text, *result)
+                for query_text, result in zip(query_texts, results)]
     except KeyError:
         raise Exception('Document does not have content and texts.')
-    except ValueError:
-        return _handle_not_found(query_text)
 
 
 class QueryHandler:
     def get_response(self, query):
         return _perform_search(query)
+
+    def get_responses(self, queries):
+        # Split large batches to bound the size of the score matrix.
+        responses = []
+        for i in range(0, len(queries), BATCH_SIZE):
+            responses += _perform_batch_search(queries[i:i + BATCH_SIZE])
+        return responses
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+
+from cachetools import TTLCache
+
+from chatbot.util.config_util import Config
+
+
+CACHE_SIZE = Config.get_value(['query_system', 'result_cache_size'])
+CACHE_TTL = Config.get_value(['query_system', 'result_cache_ttl'])
+
+# Touched by the launcher whenever the prod collection changes, so that the
+# servers running in other processes invalidate their caches.
+DATA_VERSION_FILE = Config.get_value(['query_system', 'data_version_file'])
+
+
+def normalize_query(query_text):
+    ''' Normalize a query, so that trivially different queries share a cache
+    entry. '''
+    return ' '.join(query_text.lower().split())
+
+
+def get_data_version(path=DATA_VERSION_FILE):
+    ''' Returns the version of the prod collection, or None if it has never
+    been marked as changed. '''
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def bump_data_version(path=DATA_VERSION_FILE):
+    ''' Mark the prod collection as changed. '''
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(path, 'w') as version_file:
+        version_file.write(str(time.time()))
+
+
+class QueryCache():
+    ''' Cache of ranked search results, keyed on the normalized query text.
+    Entries expire after a while, and the least recently used entries are
+    evicted when the cache is full. '''
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        ''' Static access method '''
+        if QueryCache.__instance is None:
+            QueryCache()
+        return QueryCache.__instance
+
+    def __init__(self):
+        ''' Virtually private constructor '''
+        if QueryCache.__instance is not None:
+            raise Exception('This class is a singleton!')
+        else:
+            self.__cache = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+            self.__lock = threading.Lock()
+            self.__data_version = get_data_version()
+            QueryCache.__instance = self
+
+    def get(self, query_text):
+        ''' Return the cached result for a query, or None. '''
+        with self.__lock:
+            return self.__cache.get(normalize_query(query_text))
+
+    def set(self, query_text, result):
+        ''' Store the result for a query. '''
+        with self.__lock:
+            self.__cache[normalize_query(query_text)] = result
+
+    def invalidate(self):
+        ''' Remove all cached results. Must be called whenever the knowledge
+        base changes. '''
+        with self.__lock:
+            self.__cache.clear()
+
+    def invalidate_if_changed(self, path=DATA_VERSION_FILE):
+        ''' Remove all cached results if the prod collection has changed
+        since the cache was last invalidated. Returns True if it was. '''
+        version = get_data_version(path)
+
+        with self.__lock:
+            if version == self.__data_version:
+                return False
+
+            self.__data_version = version
+            self.__cache.clear()
+
+        return True
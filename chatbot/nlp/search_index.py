@@ -0,0 +1,182 @@
+import collections
+import hashlib
+import json
+import math
+import os
+
+import scipy.sparse as sp
+
+from sklearn.preprocessing import normalize
+
+from chatbot.nlp.keyword import get_tfidf_model, tokenize_all
+from chatbot.util.config_util import Config
+
+
+INDEX_DIR = Config.get_value(['query_system', 'search_index_dir'])
+
+MATRIX_FILE = 'matrix.npz'
+META_FILE = 'index.json'
+
+
+def get_corpus_text(doc):
+    ''' Converts a document from the model into a string which will be used in
+    a corpus.  All possible answers are used to generate the corpus, if
+    multiple answers exist.'''
+    content = ' '.join(doc['content']['texts'])
+    return doc['content']['title'] + ' ' + content
+
+
+def get_text_hash(text):
+    ''' Hash of a corpus text, used to look up its row in the index. '''
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def build_search_index(corpus, directory=INDEX_DIR):
+    ''' Fit a TF-IDF model on the given corpus and persist the document-term
+    matrix together with the vocabulary and IDF weights. Rows are keyed on the
+    hash of the text, so documents which are edited after the index was built
+    are simply vectorized on the fly. '''
+    # Duplicate texts would only add identical rows.
+    corpus = list(collections.OrderedDict.fromkeys(corpus))
+
+    vectorizer, corpus_matrix, _ = get_tfidf_model(corpus)
+
+    os.makedirs(directory, exist_ok=True)
+
+    # Write to temporary files first and move them in place, so a server
+    # which is reading the index never sees a partially written file. The
+    # metadata file is moved last, as its modification time is what servers
+    # use to detect a new index.
+    matrix_path = os.path.join(directory, MATRIX_FILE)
+    meta_path = os.path.join(directory, META_FILE)
+
+    sp.save_npz(matrix_path + '.tmp.npz', corpus_matrix.tocsr())
+    os.replace(matrix_path + '.tmp.npz', matrix_path)
+
+    with open(meta_path + '.tmp', 'w') as meta_file:
+        json.dump({
+            'vocabulary': {term: int(col) for term, col
+                           in vectorizer.vocabulary_.items()},
+            'idf': vectorizer.idf_.tolist(),
+            'hashes': [get_text_hash(text) for text in corpus],
+        }, meta_file)
+    os.replace(meta_path + '.tmp', meta_path)
+
+    return len(corpus), len(vectorizer.vocabulary_)
+
+
+class SearchIndex():
+    ''' Global TF-IDF index over the prod and manual collections. The index is
+    built when new data is inserted, so answering a query only costs
+    transforming the query and a sparse dot product. '''
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        ''' Static access method '''
+        if SearchIndex.__instance is None:
+            SearchIndex()
+        return SearchIndex.__instance
+
+    def __init__(self):
+        ''' Virtually private constructor '''
+        if SearchIndex.__instance is not None:
+            raise Exception('This class is a singleton!')
+        else:
+            # All index data is kept in one tuple, so that it can be swapped
+            # atomically when a new index is loaded.
+            self.__index = None
+            self.__mtime = None
+            self.load()
+            SearchIndex.__instance = self
+
+    def is_loaded(self):
+        return self.__index is not None
+
+    def load(self, directory=INDEX_DIR):
+        ''' Load the index from disk, if one has been built. '''
+        self.__directory = directory
+        meta_path = os.path.join(directory, META_FILE)
+
+        try:
+            mtime = os.stat(meta_path).st_mtime
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            matrix = sp.load_npz(os.path.join(directory, MATRIX_FILE))
+        except (OSError, ValueError):
+            return False
+
+        rows = {text_hash: row for row, text_hash in enumerate(meta['hashes'])}
+        self.__index = (meta['vocabulary'], meta['idf'], matrix.tocsr(), rows)
+        self.__mtime = mtime
+
+        return True
+
+    def reload_if_changed(self):
+        ''' Reload the index if it has been rebuilt since it was loaded. '''
+        try:
+            mtime = os.stat(os.path.join(self.__directory, META_FILE)).st_mtime
+        except OSError:
+            return False
+
+        if mtime != self.__mtime:
+            return self.load(self.__directory)
+
+        return False
+
+    def transform(self, texts):
+        ''' Vectorize texts the same way the indexed corpus was vectorized. '''
+        vocabulary, idf, _, _ = self.__index
+
+        # The vectorizer lowercases documents before tokenizing them.
+        tokenized_texts = tokenize_all(text.lower() for text in texts)
+
+        rows, cols, values = [], [], []
+        for i, tokens in enumerate(tokenized_texts):
+            counts = collections.Counter(
+                vocabulary[token] for token in tokens if token in vocabulary
+            )
+
+            for col, count in counts.items():
+                rows.append(i)
+                cols.append(col)
+                # Sublinear term frequency, as used when fitting the index.
+                values.append((1 + math.log(count)) * idf[col])
+
+        matrix = sp.csr_matrix((values, (rows, cols)),
+                               shape=(len(texts), len(vocabulary)))
+
+        return normalize(matrix)
+
+    def get_vectors(self, texts):
+        ''' Retrieve the document vectors for the given corpus texts. Texts
+        which are not in the index are vectorized on the fly. '''
+        _, _, matrix, rows = self.__index
+
+        hashes = [get_text_hash(text) for text in texts]
+        missing = [text for text, text_hash in zip(texts, hashes)
+                   if text_hash not in rows]
+
+        if not missing:
+            return matrix[[rows[text_hash] for text_hash in hashes]]
+
+        missing_vectors = iter(self.transform(missing))
+
+        return sp.vstack([
+            matrix[rows[text_hash]] if text_hash in rows
+            else next(missing_vectors)
+            for text_hash in hashes
+        ]).tocsr()
+
+    def score(self, query, texts):
+        ''' Cosine similarity between the query and each of the texts. '''
+        return self.score_batch([query], texts).toarray().ravel()
+
+    def score_batch(self, queries, texts):
+        ''' Cosine similarity between every query and every text, as a sparse
+        matrix with a row for each query. Every vector is L2-normalized, so
+        this is a plain sparse product. '''
+        query_vectors = self.transform(queries)
+        document_vectors = self.get_vectors(texts)
+
+        return (query_vectors * document_vectors.T).tocsr()
@@ -0,0 +1,52 @@
+import functools
+import threading
+
+from spellchecker import SpellChecker
+
+from chatbot.util.config_util import Config
+
+
+DICTIONARY_FILE = Config.get_value(['query_system', 'spelling_dictionary'])
+CACHE_SIZE = Config.get_value(['query_system', 'spelling_cache_size'])
+
+
+class SpellingCorrector():
+    ''' Shared spell checker. The dictionary is only parsed the first time a
+    correction is needed, and corrections are cached across all queries. '''
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        ''' Static access method '''
+        if SpellingCorrector.__instance is None:
+            SpellingCorrector()
+        return SpellingCorrector.__instance
+
+    def __init__(self):
+        ''' Virtually private constructor '''
+        if SpellingCorrector.__instance is not None:
+            raise Exception('This class is a singleton!')
+        else:
+            self.__spell = None
+            self.__lock = threading.Lock()
+            # Bounded LRU cache of token -> correction, with hit/miss stats.
+            self.correction = functools.lru_cache(maxsize=CACHE_SIZE)(
+                self.__correction)
+            SpellingCorrector.__instance = self
+
+    def __get_spell_checker(self):
+        ''' Load the dictionary the first time it is needed. '''
+        if self.__spell is None:
+            with self.__lock:
+                if self.__spell is None:
+                    self.__spell = SpellChecker(
+                        local_dictionary=DICTIONARY_FILE)
+        return self.__spell
+
+    def __correction(self, token):
+        ''' Return the most likely spelling of the given token. '''
+        return self.__get_spell_checker().correction(token)
+
+    def cache_info(self):
+        ''' Hits, misses and size of the correction cache. '''
+        return self.correction.cache_info()
@@ -1,4 +1,3 @@
-import copy
 import json
 
 from chatbot.util.config_util import Config
@@ -28,10 +27,16 @@ class SynsetWrapper():
             self.__read_synset_file()
             SynsetWrapper.__instance = self
 
+    @property
+    def synset_list(self):
+        return self.__index[0]
+
     def get_synset(self, token):
-        ''' Return a synset for a given token '''
-        return next((copy.deepcopy(synset) for synset in self.synset_list
-                    if token in synset), None)
+        ''' Return a synset for a given token. The synset is immutable, and
+        shared between all callers. '''
+        synsets, synset_ids = self.__index
+        synset_id = synset_ids.get(token)
+        return synsets[synset_id] if synset_id is not None else None
 
     @staticmethod
     def synset_file_updated():
@@ -39,10 +44,19 @@ class SynsetWrapper():
         SynsetWrapper.get_instance().__read_synset_file()
 
     def __read_synset_file(self):
-        ''' Read the contents of the synset file and add them to the
-        synset_list '''
+        ''' Read the contents of the synset file and build an index from
+        each token to the synset it belongs to '''
         with open(SYNSET_FILE) as synset_file:
-            self.synset_list = [
-                [lemmatize(*token)[0] for token in synset]
+            synsets = tuple(
+                frozenset(lemmatize(*token)[0] for token in synset)
                 for synset in json.load(synset_file)
-            ]
+            )
+
+        synset_ids = {}
+        for synset_id, synset in enumerate(synsets):
+            for token in synset:
+                # A token in several synsets maps to the first of them.
+                synset_ids.setdefault(token, synset_id)
+
+        # Swap in the new synsets and index in a single assignment.
+        self.__index = (synsets, synset_ids)
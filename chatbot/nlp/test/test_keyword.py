@@ -0,0 +1,50 @@
+from chatbot.nlp.keyword import fit_tfidf_vectorizer, get_keywords, \
+                                get_keywords_batch, get_lemma_cache_info, \
+                                get_tfidf_model, is_stopword, lemmatize, \
+                                tokenize, tokenize_all
+
+
+def test_lemmatize_is_cached():
+    lemma = lemmatize('barnehager', 'NOUN')
+    hits = get_lemma_cache_info().hits
+
+    assert lemmatize('barnehager', 'NOUN') == lemma
+    assert get_lemma_cache_info().hits == hits + 1
+
+
+def test_tokenize_all_matches_tokenize():
+    docs = ['Husebybadet er åpent alle dager fra 09:00.',
+            'Søknad om bolig sendes til kommunen!']
+    assert list(tokenize_all(docs)) == [tokenize(doc) for doc in docs]
+
+
+def test_stopwords():
+    assert is_stopword('og')
+    assert not is_stopword('barnehage')
+    assert 'og' not in tokenize('Bolig og barnehage')
+
+
+def test_get_keywords_batch():
+    docs = ['Husebybadet er åpent alle dager fra 09:00.',
+            'Søknad om bolig sendes til kommunen!',
+            'Barnehager i kommunen har åpent hver dag.']
+    vectorizer, _, feature_names = get_tfidf_model(docs)
+
+    keywords = get_keywords_batch(vectorizer, feature_names, docs)
+    assert keywords == [get_keywords(vectorizer, feature_names, doc)
+                        for doc in docs]
+
+    # The top keywords are the first of all keywords.
+    top_keywords = get_keywords_batch(vectorizer, feature_names, docs, n=2)
+    assert top_keywords == [doc_keywords[:2] for doc_keywords in keywords]
+
+
+def test_fit_tfidf_vectorizer():
+    docs = ['Husebybadet er åpent alle dager fra 09:00.',
+            'Søknad om bolig sendes til kommunen!',
+            'Barnehager i kommunen har åpent hver dag.']
+    vectorizer, _, feature_names = get_tfidf_model(docs)
+    fitted, fitted_feature_names = fit_tfidf_vectorizer(docs)
+
+    assert fitted_feature_names == feature_names
+    assert list(fitted.idf_) == list(vectorizer.idf_)
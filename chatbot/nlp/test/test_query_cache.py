@@ -0,0 +1,40 @@
+import pytest
+
+from chatbot.nlp.query_cache import QueryCache, bump_data_version
+
+
+def test_query_cache_singleton_constructor():
+    QueryCache.get_instance()
+    with pytest.raises(Exception):
+        assert QueryCache()
+
+
+def test_query_cache_normalizes_queries():
+    cache = QueryCache.get_instance()
+    cache.set('Åpningstider  Husebybadet', ([], None))
+
+    assert cache.get('åpningstider husebybadet') == ([], None)
+    assert cache.get('åpningstider') is None
+
+
+def test_query_cache_invalidate():
+    cache = QueryCache.get_instance()
+    cache.set('åpningstider husebybadet', ([], None))
+    cache.invalidate()
+
+    assert cache.get('åpningstider husebybadet') is None
+
+
+def test_query_cache_invalidate_if_changed(tmp_path):
+    cache = QueryCache.get_instance()
+    path = str(tmp_path / 'data_version')
+    cache.invalidate_if_changed(path)
+
+    cache.set('åpningstider husebybadet', ([], None))
+    assert not cache.invalidate_if_changed(path)
+    assert cache.get('åpningstider husebybadet') == ([], None)
+
+    # The launcher marks the prod collection as changed
+    bump_data_version(path)
+    assert cache.invalidate_if_changed(path)
+    assert cache.get('åpningstider husebybadet') is None
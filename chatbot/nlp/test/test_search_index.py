@@ -0,0 +1,46 @@
+from sklearn.metrics.pairwise import cosine_similarity
+
+from chatbot.nlp.keyword import get_tfidf_model
+from chatbot.nlp.search_index import SearchIndex, build_search_index
+
+
+CORPUS = [
+    'Åpningstider Husebybadet er åpent alle dager fra 09:00 til 20:00',
+    'Bolig med tjenester Søknad om bolig sendes til kommunen',
+    'Barnehage I Trondheim er det mange barnehager',
+]
+
+
+def load_index(directory):
+    ''' Load an index without the singleton, so that the index used by the
+    other tests is left as it is. '''
+    index = SearchIndex.__new__(SearchIndex)
+    assert index.load(directory)
+    return index
+
+
+def test_search_index_matches_fitted_model(tmp_path):
+    build_search_index(CORPUS, str(tmp_path))
+
+    index = load_index(str(tmp_path))
+
+    # The index should score exactly like a model fitted on the same corpus.
+    query = 'åpningstider bolig'
+    vectorizer, corpus_matrix, _ = get_tfidf_model(CORPUS)
+    expected = cosine_similarity(vectorizer.transform([query]),
+                                 corpus_matrix)[0]
+
+    scores = index.score(query, CORPUS)
+    assert [round(score, 6) for score in scores] == \
+           [round(score, 6) for score in expected]
+
+
+def test_search_index_vectorizes_unknown_texts(tmp_path):
+    build_search_index(CORPUS, str(tmp_path))
+
+    index = load_index(str(tmp_path))
+
+    # Texts which were changed after the index was built are still scored.
+    scores = index.score('barnehager', ['Barnehager i kommunen', CORPUS[0]])
+    assert scores[0] > 0
+    assert scores[1] == 0
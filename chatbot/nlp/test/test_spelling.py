@@ -0,0 +1,19 @@
+import pytest
+
+from chatbot.nlp.spelling import SpellingCorrector
+
+
+def test_spelling_corrector_singleton_constructor():
+    SpellingCorrector.get_instance()
+    with pytest.raises(Exception):
+        assert SpellingCorrector()
+
+
+def test_spelling_corrector_caches_corrections():
+    spell = SpellingCorrector.get_instance()
+
+    first = spell.correction('åpningstid')
+    hits = spell.cache_info().hits
+
+    assert spell.correction('åpningstid') == first
+    assert spell.cache_info().hits == hits + 1
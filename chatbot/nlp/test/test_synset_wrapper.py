@@ -20,3 +20,11 @@ def test_get_synset_list():
     wrapper = SynsetWrapper.get_instance()
     synset = wrapper.get_synset('tlf')
     assert 'epost' in synset
+
+
+def test_get_synset_is_shared_and_immutable():
+    wrapper = SynsetWrapper.get_instance()
+    synset = wrapper.get_synset('tlf')
+    assert isinstance(synset, frozenset)
+    assert wrapper.get_synset('epost') is synset
+    assert wrapper.get_synset('sakfscfdsojimad') is None
@@ -0,0 +1,172 @@
+import functools
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from nltk.corpus import wordnet as wn
+
+from chatbot.nlp.keyword import lemmatize, tag_all
+from chatbot.util.config_util import Config
+
+
+TABLE_FILE = Config.get_value(['query_system', 'wordnet_table_file'])
+CACHE_SIZE = Config.get_value(['query_system', 'wordnet_cache_size'])
+
+# Spacy POS tags which have a WordNet counterpart. Other tags are looked up
+# without a POS restriction.
+WORDNET_POS = {
+    'NOUN': wn.NOUN,
+    'VERB': wn.VERB,
+    'ADJ': wn.ADJ,
+    'ADV': wn.ADV,
+}
+
+# The table file starts with the number of records, followed by the offsets
+# of all records relative to the start of the record data.
+HEADER = struct.Struct('<q')
+
+
+def _get_key(lemma, pos):
+    ''' Key of a (lemma, POS) pair in the table. '''
+    return '{}\t{}'.format(lemma, pos or '').encode()
+
+
+def get_wordnet_synonyms(lemma, pos):
+    ''' Find all Norwegian synonyms of a lemma in WordNet. '''
+    synonyms = set()
+
+    for synset in wn.synsets(lemma, lang='nob', pos=pos):
+        # Find all lemmas in the synset.
+        for name in synset.lemma_names(lang='nob'):
+            # Some lemmas contain underscores, which we remove.
+            synonyms.add(name.replace('_', ' '))
+
+    return sorted(synonyms)
+
+
+def build_wordnet_table(corpus, table_file=TABLE_FILE):
+    ''' Look up WordNet synonyms for every (lemma, POS) pair in the corpus,
+    and store them in a sorted table which can be memory mapped. '''
+    pairs = set()
+    for tagged_text in tag_all(corpus):
+        for token in tagged_text:
+            pairs.add((lemmatize(token.text, token.pos_)[0],
+                       WORDNET_POS.get(token.pos_)))
+
+    records = sorted(
+        _get_key(lemma, pos) + b'\n'
+        + '\t'.join(get_wordnet_synonyms(lemma, pos)).encode()
+        for lemma, pos in pairs
+    )
+
+    offsets = np.zeros(len(records) + 1, dtype='<i8')
+    offsets[1:] = np.cumsum([len(record) for record in records])
+
+    directory = os.path.dirname(table_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    # Replace the table in one step, so a server which is reading it never
+    # sees a partially written file.
+    with open(table_file + '.tmp', 'wb') as table:
+        table.write(HEADER.pack(len(records)))
+        table.write(offsets.tobytes())
+        for record in records:
+            table.write(record)
+    os.replace(table_file + '.tmp', table_file)
+
+    return len(records)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _get_live_synonyms(lemma, pos):
+    ''' Synonyms for pairs which are not in the table. '''
+    return tuple(get_wordnet_synonyms(lemma, pos))
+
+
+class WordNetTable():
+    ''' Precomputed WordNet synonyms for the vocabulary of the corpus. The
+    table is memory mapped, and pairs which are missing from it are looked up
+    in WordNet directly. '''
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        ''' Static access method '''
+        if WordNetTable.__instance is None:
+            WordNetTable()
+        return WordNetTable.__instance
+
+    def __init__(self):
+        ''' Virtually private constructor '''
+        if WordNetTable.__instance is not None:
+            raise Exception('This class is a singleton!')
+        else:
+            self.__table = None
+            self.__mtime = None
+            self.load()
+            WordNetTable.__instance = self
+
+    def load(self, table_file=TABLE_FILE):
+        ''' Memory map the table, if one has been built. '''
+        self.__table_file = table_file
+
+        try:
+            mtime = os.stat(table_file).st_mtime
+            with open(table_file, 'rb') as table:
+                data = mmap.mmap(table.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+
+        n_records, = HEADER.unpack_from(data)
+        offsets = np.frombuffer(data, dtype='<i8', count=n_records + 1,
+                                offset=HEADER.size)
+        base = HEADER.size + offsets.nbytes
+
+        self.__table = (data, offsets, base)
+        self.__mtime = mtime
+
+        return True
+
+    def reload_if_changed(self):
+        ''' Reload the table if it has been rebuilt since it was loaded. '''
+        try:
+            mtime = os.stat(self.__table_file).st_mtime
+        except OSError:
+            return False
+
+        if mtime != self.__mtime:
+            return self.load(self.__table_file)
+
+        return False
+
+    def __find(self, key):
+        ''' Binary search for the record with the given key. '''
+        data, offsets, base = self.__table
+
+        low, high = 0, len(offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            record = data[base + offsets[middle]:base + offsets[middle + 1]]
+            record_key, _, synonyms = record.partition(b'\n')
+
+            if record_key == key:
+                return synonyms
+            elif record_key < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        return None
+
+    def get_synonyms(self, lemma, pos):
+        ''' Return the WordNet synonyms for a lemma with the given WordNet
+        POS tag, or any POS if it is None. '''
+        if self.__table is not None:
+            synonyms = self.__find(_get_key(lemma, pos))
+            if synonyms is not None:
+                return synonyms.decode().split('\t') if synonyms else []
+
+        return list(_get_live_synonyms(lemma, pos))
@@ -0,0 +1,42 @@
+import hashlib
+import math
+
+
+class BloomFilter():
+    ''' Compact set of strings which answers whether a string may have been
+    added before. Strings which were added are always reported as seen, while
+    strings which were not are reported as seen with a probability of at most
+    error_rate, as long as no more than capacity strings are added. '''
+
+    def __init__(self, capacity, error_rate):
+        # Optimal number of bits and hash functions for the capacity.
+        self.n_bits = max(1, math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def _positions(self, item):
+        ''' Bit positions of an item, using double hashing of one digest. '''
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(first + i * second) % self.n_bits
+                for i in range(self.n_hashes)]
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    def add(self, item):
+        ''' Add an item. Returns False if the item may have been added
+        before, and True if it is certainly new. '''
+        is_new = False
+
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                is_new = True
+
+        return is_new
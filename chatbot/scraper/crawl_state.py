@@ -0,0 +1,97 @@
+import json
+import os
+import sqlite3
+import time
+
+
+class CrawlStateStore():
+    ''' Persistent state of the pages which have been crawled, stored in
+    SQLite. For every URL, the ETag and Last-Modified headers are kept for
+    conditional requests, together with the links which were followed from
+    the page and the time it was crawled.
+
+    The state of a crawl is staged, and is only used for conditional requests
+    once it is committed. It is committed after the exported pages have been
+    written to the database, so that pages which failed to be written are
+    requested and exported again by the next crawl. '''
+
+    # Commit after this many updates, instead of after every page.
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path)
+        for table in ('pages', 'staged_pages'):
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS {} (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    links TEXT,
+                    crawled_at REAL
+                )
+            '''.format(table))
+        self.n_updates = 0
+
+    def get(self, url):
+        ''' Returns the committed state of a page, or None if it has not been
+        crawled before. '''
+        row = self.connection.execute(
+            'SELECT etag, last_modified, links, crawled_at '
+            'FROM pages WHERE url = ?', (url,)).fetchone()
+
+        if row is None:
+            return None
+
+        etag, last_modified, links, crawled_at = row
+        return {
+            'etag': etag,
+            'last_modified': last_modified,
+            'links': json.loads(links) if links else [],
+            'crawled_at': crawled_at,
+        }
+
+    def set(self, url, etag, last_modified, links):
+        ''' Stage the state of a page which was just crawled. '''
+        self.connection.execute(
+            'INSERT OR REPLACE INTO staged_pages '
+            '(url, etag, last_modified, links, crawled_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (url, etag, last_modified, json.dumps(links), time.time()))
+        self.__updated()
+
+    def touch(self, url):
+        ''' Update the crawl time of a page which was not modified. '''
+        self.connection.execute(
+            'UPDATE pages SET crawled_at = ? WHERE url = ?',
+            (time.time(), url))
+        self.__updated()
+
+    def commit_staged(self):
+        ''' Use the staged state of the pages for the next crawls. Called once
+        the pages have been written to the database. '''
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO pages '
+                '(url, etag, last_modified, links, crawled_at) '
+                'SELECT url, etag, last_modified, links, crawled_at '
+                'FROM staged_pages')
+            self.connection.execute('DELETE FROM staged_pages')
+
+    def discard_staged(self):
+        ''' Throw away the staged state of a crawl whose pages were never
+        written to the database. '''
+        with self.connection:
+            self.connection.execute('DELETE FROM staged_pages')
+
+    def __updated(self):
+        self.n_updates += 1
+        if self.n_updates % self.COMMIT_INTERVAL == 0:
+            self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -1,6 +1,8 @@
+import itertools
 import re
 import unicodedata
 
+from concurrent.futures import ProcessPoolExecutor
 from hashlib import sha1
 
 from urllib.parse import urlparse
@@ -10,29 +12,60 @@ import scrapy
 from scrapy.linkextractors import LinkExtractor
 from scrapy.http import HtmlResponse
 
-from bs4 import BeautifulSoup
+from twisted.internet import defer, reactor
 
-from anytree import RenderTree, NodeMixin
-from anytree.exporter import DictExporter
+from lxml.cssselect import CSSSelector
 
+from chatbot.scraper.bloom_filter import BloomFilter
+from chatbot.scraper.crawl_state import CrawlStateStore
 from chatbot.util.config_util import Config
 
 
-class TreeElement(NodeMixin):
-    # A counter used to give an unique ID to all nodes.
-    counter = 0
+def combine_patterns(patterns):
+    ''' Compile a list of regular expressions into one, which matches at the
+    start of a string wherever one of them does. Returns None if the list is
+    empty. '''
+    if not patterns:
+        return None
 
-    def __init__(self, tag, page_id, text=None, parent=None):
-        ''' Tree node which stores information about an HTML tag. '''
+    return re.compile('^(?:{})'.format(
+        '|'.join('(?:{})'.format(pattern) for pattern in patterns)))
+
+
+class TreeElement():
+    __slots__ = ('tag', 'text', 'parent', 'children', 'id')
+
+    def __init__(self, tag, node_ids, text=None, parent=None):
+        ''' Tree node which stores information about an HTML tag. The id of
+        the node is taken from node_ids, which generates the ids of a single
+        page. '''
 
         self.tag = tag
         self.text = text
         self.parent = parent
+        self.children = []
+
+        if parent is not None:
+            parent.children.append(self)
 
         # We hash the URL of all pages and add a counter for the element
         # after it. This is used to diff new and stored HTML pages.
-        self.id = '{}-{}'.format(page_id, TreeElement.counter)
-        TreeElement.counter += 1
+        self.id = next(node_ids)
+
+    def export(self):
+        ''' Export the tree below this node as a dictionary. Scrapy will
+        then convert it to a JSON structure. '''
+        tree = {'tag': self.tag, 'text': self.text, 'id': self.id}
+
+        if self.children:
+            tree['children'] = [child.export() for child in self.children]
+
+        return tree
+
+
+def get_node_ids(page_id):
+    ''' Generate the ids of the nodes on a page, counting from 0. '''
+    return ('{}-{}'.format(page_id, i) for i in itertools.count())
 
 
 class InfoGatheringSpider(scrapy.Spider):
@@ -51,6 +84,26 @@ class InfoGatheringSpider(scrapy.Spider):
 
     debug = 'debug' if config['debug'] else None
 
+    # Enable to only scrape pages which changed since the last crawl, with
+    # -a incremental=true. The state of every crawled page is stored, and
+    # pages are requested conditionally using their ETag and Last-Modified
+    # headers. Pages which are unchanged are not exported, but their links
+    # are still followed. The state of a crawl is staged until launch.py has
+    # written the exported pages to the database.
+    incremental = False
+
+    # Where the state of crawled pages is stored in incremental mode.
+    crawl_state_file = config['crawl_state_file']
+
+    # Unchanged pages are answered with 304 Not Modified, which is passed on
+    # to the parse method.
+    handle_httpstatus_list = [304]
+
+    # Number of worker processes which generate page trees. Parsing is CPU
+    # bound, so with many concurrent requests it is spread over several
+    # cores. If 0, pages are parsed in the Scrapy process.
+    parse_workers = config['parse_workers']
+
     # Elements which sometimes are used to indicate a header.
     alternative_headers = config['alternative_headers']
 
@@ -63,20 +116,40 @@ class InfoGatheringSpider(scrapy.Spider):
     ]
 
     # Paths on the site which are allowed. Only paths which match
-    # these will ever be visited.
-    allowed_paths = list(map(re.compile, config['url']['allowed_paths']))
+    # these will ever be visited. Each list of patterns is combined into a
+    # single regular expression.
+    allowed_paths = combine_patterns(config['url']['allowed_paths'])
 
     # Pages in this list will be visited and links on them will
     # be visited, however the data will not be scraped.
-    scrape_blacklist = list(map(re.compile, config['blacklist']['scrape']))
+    scrape_blacklist = combine_patterns(config['blacklist']['scrape'])
 
     # These links will never be visited, even if the path is allowed above.
-    visit_blacklist = list(map(re.compile, config['blacklist']['visit']))
+    visit_blacklist = combine_patterns(config['blacklist']['visit'])
+
+    # Extracts the links to follow from a page. If no paths are allowed, no
+    # links are followed.
+    link_extractor = LinkExtractor(
+        allow=allowed_paths,
+        deny=visit_blacklist or (),
+    ) if allowed_paths else None
+
+    # Links which have already been followed are remembered in a Bloom
+    # filter, so no request is created for them again. A link which was not
+    # followed is mistaken for a followed one with a probability of at most
+    # the error rate.
+    seen_urls_capacity = config['seen_urls']['capacity']
+    seen_urls_error_rate = config['seen_urls']['error_rate']
 
     # These selectors will be removed from all pages, as they contain very
     # little actual information, and are equal on all pages.
     garbage_elements = set(config['blacklist']['elements'])
 
+    # All garbage selectors compiled into one, which finds every garbage
+    # element on a page in a single pass.
+    garbage_selector = CSSSelector(', '.join(sorted(garbage_elements))) \
+        if garbage_elements else None
+
     # Elements containing text equal to one of these sentences will be
     # removed from all pages.
 
@@ -84,11 +157,11 @@ class InfoGatheringSpider(scrapy.Spider):
 
     # Elements containing an url in href that starts with the following
     # will be removed
-    garbage_start_urls = set(config['blacklist']['garbage_start_urls'])
+    garbage_start_urls = tuple(config['blacklist']['garbage_start_urls'])
 
     # Elements containing an url in href that ends with the following
     # will be removed.
-    garbage_resources = set(config['blacklist']['resources'])
+    garbage_resources = tuple(config['blacklist']['resources'])
 
     # The text used for the title on 404 pages. Used to detect silent 404
     # error.
@@ -109,21 +182,127 @@ class InfoGatheringSpider(scrapy.Spider):
     # if their parent is in the set of parents.
     ignored_child_tags = config['blacklist']['ignored_child_tags_for_parents']
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Spider arguments are given as strings.
+        self.incremental = str(self.incremental).lower() in ('true', '1')
+
+        self.crawl_state = None
+        if self.incremental:
+            self.crawl_state = CrawlStateStore(self.crawl_state_file)
+            # The pages of an earlier crawl which was never written to the
+            # database are crawled again.
+            self.crawl_state.discard_staged()
+
+        # Created when the first links are followed, so that spiders which
+        # only scrape pages do not allocate it.
+        self.seen_urls = None
+
+        self.parse_pool = None
+        if int(self.parse_workers) > 0:
+            self.parse_pool = ProcessPoolExecutor(int(self.parse_workers))
+
+    def closed(self, reason):
+        ''' Called by Scrapy when the crawl is finished. '''
+        if self.crawl_state:
+            self.crawl_state.close()
+
+        if self.parse_pool:
+            self.parse_pool.shutdown()
+
+    def start_requests(self):
+        for url in self.start_urls:
+            yield self.make_request(url)
+
+    def follow_links(self, urls, response):
+        ''' Create requests for the links on a page which have not been
+        followed before. '''
+        if self.seen_urls is None:
+            self.seen_urls = BloomFilter(int(self.seen_urls_capacity),
+                                         float(self.seen_urls_error_rate))
+
+        for url in urls:
+            if self.seen_urls.add(url):
+                yield self.make_request(url, response)
+
+    def make_request(self, url, response=None):
+        ''' Create a request for an url, relative to the response if given.
+        In incremental mode, the request is conditional on the page being
+        modified since it was last crawled. '''
+        headers = {}
+        state = self.crawl_state.get(url) if self.crawl_state else None
+
+        if state:
+            if state['etag']:
+                headers['If-None-Match'] = state['etag']
+            if state['last_modified']:
+                headers['If-Modified-Since'] = state['last_modified']
+
+        if response:
+            return response.follow(url, self.parse, headers=headers)
+
+        return scrapy.Request(url, self.parse, headers=headers)
+
     def normalize(self, text):
         return unicodedata.normalize('NFKC', text)
 
-    def extract_metadata(self, root, soup, page_id):
-        ''' Extract keywords metadata from the header of the page and add them
-        as children of the tree root element. '''
+    def extract_metadata(self, root, keywords, node_ids):
+        ''' Extract keywords metadata from the keywords meta tag in the
+        header of the page, if any, and add them as children of the tree root
+        element. '''
 
-        # Attempt finding the keywords meta tag on the page.
-        keywords = soup.find('meta', attrs={'name': 'keywords'})
-
-        if keywords and 'content' in keywords.attrs:
+        if keywords is not None and 'content' in keywords.attrib:
             # Add the keywords beneath the title in the tree, if the meta tag
             # has the content attribute correctly specified.
-            TreeElement('meta', page_id,
-                        keywords.attrs['content'], parent=root)
+            TreeElement('meta', node_ids,
+                        keywords.attrib['content'], parent=root)
+
+    def iter_elements(self, elem, garbage):
+        ''' Iterate over an element and all its descendants in document
+        order, leaving out garbage elements and everything inside them. '''
+        stack = [elem]
+
+        while stack:
+            elem = stack.pop()
+
+            # Comments and processing instructions are not elements.
+            if elem in garbage or not isinstance(elem.tag, str):
+                continue
+
+            yield elem
+            stack.extend(reversed(elem))
+
+    def get_text(self, elem, garbage):
+        ''' Get all text inside an element, where BR tags are replaced with
+        newlines and garbage elements are left out. '''
+        parts = []
+        stack = [elem]
+
+        # Each entry is either an element to visit, or the text following an
+        # element which has been visited.
+        while stack:
+            item = stack.pop()
+
+            if isinstance(item, str):
+                parts.append(item)
+                continue
+
+            if item.tail and item is not elem:
+                stack.append(item.tail)
+
+            if item in garbage or not isinstance(item.tag, str):
+                continue
+
+            if item.tag == 'br':
+                parts.append('\n')
+                continue
+
+            if item.text:
+                parts.append(item.text)
+            stack.extend(reversed(item))
+
+        return ''.join(parts)
 
     def locate_parent(self, elem_tag, current_parent, root):
         ''' Locate the parent element on which we should insert the next
@@ -183,52 +362,59 @@ class InfoGatheringSpider(scrapy.Spider):
         is based on headers, creating a hierarchy based on text pieces which
         are positioned in between different types of headers. '''
 
-        # Reset id to 0 when on a new page.
-        TreeElement.counter = 0
-
-        # Hash the page URL, it will be used as an ID.
+        # Hash the page URL, it will be used as an ID. The ids of the nodes
+        # count from 0 on every page, also when pages are parsed
+        # concurrently.
         page_id = sha1(response.url.encode()).hexdigest()
+        node_ids = get_node_ids(page_id)
 
-        # Parse the HTML using BeautifulSoup. Make sure we use LXML for
-        # parsing.
-        soup = BeautifulSoup(response.text, 'lxml')
-
-        # We only care about elements on the page which are defined in the
-        # hierarchy.
-        elements = soup.find_all(self.hierarchy.keys())
+        # The HTML is parsed with LXML by Scrapy. The parsed document is
+        # shared with the link extractor, so it must not be modified.
+        document = response.selector.root
 
-        # We remove the header and footer tags from the page to reduce
+        # We leave out the header and footer tags from the page to reduce
         # bloat, as these contain little useful information.
-        for garbage_selector in self.garbage_elements:
-            for garbage_element in soup.select(garbage_selector):
-                garbage_element.decompose()
+        garbage = set(self.garbage_selector(document)) \
+            if self.garbage_selector is not None else set()
+
+        # We only care about elements on the page which are defined in the
+        # hierarchy, as well as the title and the keywords meta tag. They are
+        # all found in one pass over the page.
+        title_elem = None
+        keywords = None
+        elements = []
+
+        for elem in self.iter_elements(document, garbage):
+            if elem.tag in self.hierarchy:
+                elements.append(elem)
+            elif elem.tag == 'title' and title_elem is None:
+                title_elem = elem
+            elif elem.tag == 'meta' and keywords is None and \
+                    elem.get('name') == 'keywords':
+                keywords = elem
 
         # Locate the title element. It might be used for the tree root.
-        title = self.normalize(soup.find('title').text.strip())
+        title = self.normalize(self.get_text(title_elem, garbage).strip())
 
         # Do not continue with this page if we detect it as a silent 404.
         if self.not_found_text in title:
             return
 
         # Use the title as the tree root.
-        root = TreeElement('title', page_id, title)
+        root = TreeElement('title', node_ids, title)
 
         # Attempt extracting the keywords and adding them to the tree.
-        self.extract_metadata(root, soup, page_id)
+        self.extract_metadata(root, keywords, node_ids)
 
         # Current position in the hierarchy.
         current_parent = root
 
         for elem in elements:
-            # Replace BR tags with newlines.
-            for br in elem.find_all('br'):
-                br.replace_with('\n')
-
             # Remove trailing and tailing spaces from the node contents.
-            elem_text = self.normalize(elem.text.strip())
+            elem_text = self.normalize(self.get_text(elem, garbage).strip())
 
             # Find the type of this element.
-            elem_tag = elem.name
+            elem_tag = elem.tag
 
             # Do not allow tree nodes with empty text.
             if not elem_text:
@@ -255,13 +441,17 @@ class InfoGatheringSpider(scrapy.Spider):
 
                 if elem_tag == 'p':
                     # Find all alternative header tags inside this paragraph.
-                    headers = elem.find_all(self.alternative_headers)
+                    headers = [header for header
+                               in self.iter_elements(elem, garbage)
+                               if header is not elem and
+                               header.tag in self.alternative_headers]
 
                     # Check if there is only 1 alternative header tag, and
                     # check if it contains all of the text inside the
                     # paragraph.
                     if len(headers) == 1 and elem_text \
-                            == self.normalize(headers[0].text.strip()):
+                            == self.normalize(
+                                self.get_text(headers[0], garbage).strip()):
                         # Locate the parent in which a H6 tag would be
                         # inserted.
                         parent = self.locate_parent('h6',
@@ -271,7 +461,7 @@ class InfoGatheringSpider(scrapy.Spider):
                         # Add a custom H6 element.
                         current_parent = TreeElement(
                             'h6',
-                            page_id,
+                            node_ids,
                             elem_text,
                             parent,
                         )
@@ -327,7 +517,7 @@ class InfoGatheringSpider(scrapy.Spider):
                 # Create the new element.
                 current_parent = TreeElement(
                     elem_tag,
-                    page_id,
+                    node_ids,
                     elem_text,
                     parent,
                 )
@@ -345,15 +535,13 @@ class InfoGatheringSpider(scrapy.Spider):
             return None
 
         # Check if the url stars with blacklisted characters
-        for start_url in self.garbage_start_urls:
-            if url.startswith(start_url):
-                return None
+        if url.startswith(self.garbage_start_urls):
+            return None
 
         # Check if the url is a blacklisted resource or file type
-        for end_url in self.garbage_resources:
-            if url.endswith(end_url):
-                # This url is blacklisted, ignore this element
-                return None
+        if url.endswith(self.garbage_resources):
+            # This url is blacklisted, ignore this element
+            return None
 
         # If the url is relative or a valid resource link
         if not bool(urlparse(url).netloc):
@@ -365,51 +553,144 @@ class InfoGatheringSpider(scrapy.Spider):
     def pretty_print_tree(self, root):
         ''' Print a scraped tree for debugging. '''
 
-        for pre, fill, node in RenderTree(root):
+        # Each entry is a node, the prefix of its children and whether it
+        # is the last child of its parent.
+        stack = [(root, '', None)]
+        while stack:
+            node, indent, last = stack.pop()
+
+            if last is None:
+                pre, child_indent = '', ''
+            else:
+                pre = indent + ('└── ' if last else '├── ')
+                child_indent = indent + ('    ' if last else '│   ')
+
             # We remove newlines from the text with spaces to preserve
             # the shape of the tree when printing in the terminal.
             print('{}{}: {}'.format(pre, node.tag,
                                     node.text.replace('\n', ' ')))
 
+            for i, child in reversed(list(enumerate(node.children))):
+                stack.append((child, child_indent,
+                              i == len(node.children) - 1))
+
         # Also add a new line before the next tree.
         print()
 
+    def scrape_page(self, response):
+        ''' Generate the tree of a page and find the links to follow on it.
+        Returns the exported tree, or None if the page is not scraped, and
+        the urls of the links. '''
+        tree = None
+
+        if not self.scrape_blacklist or \
+                not self.scrape_blacklist.match(response.url):
+            # Generate a tree structure describing this page.
+            root = self.generate_tree(response)
+
+            # The parser might choose to ignore this page, for example when
+            # we detect that the page is a 404 page. In that case, skip the
+            # page.
+            if root:
+                # Pretty print the node tree if the DEBUG flag is set.
+                if self.debug:
+                    self.pretty_print_tree(root)
+
+                # Export the tree as a dictionary. Scrapy will then convert
+                # this dictionary to a JSON structure for us, automatically.
+                tree = root.export()
+
+        # Follow all links from allowed domains. Only links that are in the
+        # list of allowed paths, and not blacklisted, are extracted.
+        links = []
+        if self.link_extractor:
+            links = [next_page.url for next_page
+                     in self.link_extractor.extract_links(response)]
+
+        return tree, links
+
     def parse(self, response):
-        ''' Parses pages which have been requested from the server. '''
+        ''' Parses pages which have been requested from the server. When
+        the parsing pool is enabled, a Deferred is returned which fires with
+        the results once a worker has scraped the page. '''
+
+        # The page is unchanged since it was last crawled, so only follow the
+        # links which were found on it then.
+        if response.status == 304:
+            return self.follow_stored_links(response)
 
         # Only store HTML responses, not other attachments.
-        if isinstance(response, HtmlResponse):
-            if not any(re.match(regex, response.url)
-                       for regex in self.scrape_blacklist):
-                # Generate a tree structure describing this page.
-                root = self.generate_tree(response)
-
-                # The parser might choose to ignore this page, for example when
-                # we detect that the page is a 404 page. In that case, skip the
-                # page.
-                if root:
-                    # Pretty print the node tree if the DEBUG flag is set.
-                    if self.debug:
-                        self.pretty_print_tree(root)
-
-                    # Export the tree using the DictExporter. Scrapy will then
-                    # convert this dictionary to a JSON structure for us,
-                    # automatically.
-                    exporter = DictExporter()
-                    tree = exporter.export(root)
-
-                    yield {
-                        # Export the page URL and the tree structure.
-                        'url': response.url,
-                        'tree': tree,
-                    }
-
-            # Follow all links from allowed domains.
-            for next_page in LinkExtractor().extract_links(response):
-                for allowed_path in self.allowed_paths:
-                    # Only follow links that are in the list of allowed paths.
-                    if re.match(allowed_path, next_page.url) and not \
-                            any(re.match(regex, next_page.url)
-                                for regex in self.visit_blacklist):
-                        yield response.follow(next_page, self.parse)
-                        break
+        if not isinstance(response, HtmlResponse):
+            return []
+
+        if self.parse_pool is None:
+            return self.process_page(response, *self.scrape_page(response))
+
+        # Scrape the page in another process, and continue when it is done.
+        future = self.parse_pool.submit(_scrape_page, response.url,
+                                        response.body, response.encoding)
+        deferred = defer.Deferred()
+
+        def done(future):
+            if future.exception() is not None:
+                reactor.callFromThread(deferred.errback, future.exception())
+            else:
+                reactor.callFromThread(deferred.callback, future.result())
+
+        future.add_done_callback(done)
+        deferred.addCallback(
+            lambda result: list(self.process_page(response, *result)))
+
+        return deferred
+
+    def follow_stored_links(self, response):
+        ''' Follow the links stored for a page which was not modified. '''
+        state = self.crawl_state.get(response.url) \
+            if self.crawl_state else None
+
+        if state:
+            self.crawl_state.touch(response.url)
+            yield from self.follow_links(state['links'], response)
+
+    def process_page(self, response, tree, links):
+        ''' Export the tree of a scraped page and follow its links. Pages
+        which were modified are always exported, and the pages which are
+        unchanged in the database are skipped when serializing them. '''
+        if tree:
+            yield {
+                # Export the page URL and the tree structure.
+                'url': response.url,
+                'tree': tree,
+            }
+
+        yield from self.follow_links(links, response)
+
+        if self.crawl_state:
+            headers = response.headers
+            self.crawl_state.set(
+                response.url,
+                _decode_header(headers.get('ETag')),
+                _decode_header(headers.get('Last-Modified')),
+                links,
+            )
+
+
+def _decode_header(value):
+    ''' Header values are bytes in Scrapy. '''
+    return value.decode('latin-1') if value else None
+
+
+# The spider used to scrape pages in each worker process of the parsing pool.
+_worker_spider = None
+
+
+def _scrape_page(url, body, encoding):
+    ''' Scrape a page in a worker process of the parsing pool. '''
+    global _worker_spider
+
+    # The worker only scrapes pages, so it has no parsing pool of its own.
+    if _worker_spider is None:
+        _worker_spider = InfoGatheringSpider(parse_workers=0)
+
+    response = HtmlResponse(url=url, body=body, encoding=encoding)
+    return _worker_spider.scrape_page(response)
@@ -0,0 +1,18 @@
+from chatbot.scraper.bloom_filter import BloomFilter
+
+
+def test_bloom_filter():
+    """
+    Testing that added urls are always seen, and that few other urls are.
+    """
+    seen_urls = BloomFilter(1000, 0.01)
+    urls = ['https://www.trondheim.kommune.no/{}/'.format(i)
+            for i in range(1000)]
+
+    assert all(seen_urls.add(url) for url in urls[:500])
+    assert not seen_urls.add(urls[0])
+    assert all(url in seen_urls for url in urls[:500])
+
+    # Allow some slack over the error rate.
+    false_positives = sum(url in seen_urls for url in urls[500:])
+    assert false_positives < 25
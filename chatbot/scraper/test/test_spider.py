@@ -1,4 +1,4 @@
-from scrapy.http import Request, HtmlResponse
+from scrapy.http import Request, HtmlResponse, Response
 import os
 import json
 from chatbot.scraper.spiders import info_gathering_spider as igs
@@ -56,3 +56,113 @@ def test_scraper_snapshot():
     assert sorted(
         json.loads(str(html_tree_snapshot)).items()
     ) == sorted(tree_obj.items())
+
+
+def test_incremental_crawl(tmp_path):
+    """
+    Testing that a modified page is exported on every crawl, that its state
+    is only used once it is committed, and that the links of a page which
+    was not modified are followed.
+    """
+    spider = igs.InfoGatheringSpider(
+        incremental='true',
+        crawl_state_file=str(tmp_path / 'crawl_state.db'))
+
+    response = fake_response_from_file("test.html")
+    for _ in range(2):
+        items = [item for item in spider.parse(response)
+                 if isinstance(item, dict)]
+        assert len(items) == 1
+
+    # The state is staged until the pages have been written to the database.
+    assert spider.crawl_state.get(HB) is None
+    spider.crawl_state.commit_staged()
+    assert spider.crawl_state.get(HB)
+
+    # The page is requested conditionally, and its stored links are followed
+    # when it was not modified.
+    spider.crawl_state.set(HB, '"etag"', None, [HOST])
+    spider.crawl_state.commit_staged()
+    assert spider.make_request(HB).headers['If-None-Match'] == b'"etag"'
+
+    not_modified = Response(url=HB, status=304, request=Request(url=HB))
+    requests = list(spider.parse(not_modified))
+    assert [request.url for request in requests] == [HOST]
+
+    spider.closed('finished')
+
+
+def test_discard_staged_crawl_state(tmp_path):
+    """
+    Testing that the staged state of a crawl whose pages were never written
+    is thrown away by the next crawl.
+    """
+    crawl_state_file = str(tmp_path / 'crawl_state.db')
+    spider = igs.InfoGatheringSpider(incremental='true',
+                                     crawl_state_file=crawl_state_file)
+    spider.crawl_state.set(HB, '"etag"', None, [HOST])
+    spider.closed('finished')
+
+    spider = igs.InfoGatheringSpider(incremental='true',
+                                     crawl_state_file=crawl_state_file)
+    spider.crawl_state.commit_staged()
+    assert spider.crawl_state.get(HB) is None
+    assert not spider.make_request(HB).headers.get('If-None-Match')
+    spider.closed('finished')
+
+
+def test_incremental_argument():
+    """
+    Testing that the incremental spider argument is parsed as a boolean.
+    """
+    assert not igs.InfoGatheringSpider(incremental='false').incremental
+    assert not igs.InfoGatheringSpider().crawl_state
+
+
+def test_node_ids_per_page():
+    """
+    Testing that node ids are counted from 0 on every page, independent of
+    other pages.
+    """
+    ids = igs.get_node_ids('page')
+    other_ids = igs.get_node_ids('other')
+
+    root = igs.TreeElement('title', ids, 'Tittel')
+    igs.TreeElement('title', other_ids, 'Annen tittel')
+    child = igs.TreeElement('p', ids, 'Avsnitt', root)
+
+    assert root.export() == {'tag': 'title', 'text': 'Tittel', 'id': 'page-0',
+                             'children': [{'tag': 'p', 'text': 'Avsnitt',
+                                           'id': 'page-1'}]}
+    assert child.parent is root
+
+
+def test_scrape_page_in_worker():
+    """
+    Testing that a page scraped by a worker of the parsing pool gives the
+    same result as scraping it in the spider.
+    """
+    response = fake_response_from_file("test.html")
+    spider = igs.InfoGatheringSpider()
+
+    assert igs._scrape_page(response.url, response.body, response.encoding) \
+        == spider.scrape_page(response)
+
+    # The spider of the worker does not crawl, so it has no parsing pool and
+    # no filter of seen urls.
+    assert igs._worker_spider.parse_pool is None
+    assert igs._worker_spider.seen_urls is None
+
+
+def test_combine_patterns():
+    """
+    Testing that combined patterns match like each of the patterns would with
+    re.match.
+    """
+    regex = igs.combine_patterns([HOST + 'tema/', '.*husebybadet'])
+
+    assert regex.match(HB)
+    assert regex.match(HOST + 'tema/annet/')
+    assert not regex.match(HOST + 'annet/')
+    assert not regex.match('https://example.com/' + HOST + 'tema/')
+    assert igs.combine_patterns([]) is None
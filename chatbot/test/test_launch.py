@@ -0,0 +1,132 @@
+from chatbot.launch import insert_documents, update_documents
+from chatbot.model.model_factory import ModelFactory
+from chatbot.model.serializer import get_content_hash
+
+fact = ModelFactory.get_instance()
+fact.set_db()
+
+PAGE = "https://ntnu.no/page"
+OTHER_PAGE = "https://ntnu.no/other"
+COLLECTIONS = {"prod_col": "test_prod", "manual_col": "test_manual",
+               "conflict_col": "test_conflicts"}
+TEMP_COL = "test_temp"
+
+
+def make_doc(idx, url, texts, title="Åpningstider", page_hash="old"):
+    content = {"title": title, "keywords": [], "texts": texts}
+    return {"id": idx, "url": url, "content": content,
+            "content_hash": get_content_hash(content),
+            "page_hash": page_hash, "manually_changed": False}
+
+
+def drop_collections():
+    for collection in list(COLLECTIONS.values()) + [TEMP_COL]:
+        fact.get_database().drop_collection(collection)
+
+
+def update_page():
+    """ Store two pages, then update the first with one changed, one
+    unchanged and one removed paragraph. Returns the stored documents """
+    drop_collections()
+    fact.post_documents([make_doc("1", PAGE, ["Åpent alle dager"]),
+                         make_doc("2", PAGE, ["Stengt i julen"]),
+                         make_doc("3", PAGE, ["Fjernet avsnitt"]),
+                         make_doc("4", OTHER_PAGE, ["Annen side"])],
+                        "test_prod")
+
+    data = [make_doc("2", PAGE, ["Åpent i julen"], page_hash="new")]
+    changed_pages = {PAGE: {"page_hash": "new", "unchanged_ids": ["1"]}}
+    update_documents(data, changed_pages, **COLLECTIONS)
+
+    return {doc["id"]: doc for doc in fact.get_collection("test_prod").find()}
+
+
+def test_update_changed_page():
+    try:
+        docs = update_page()
+
+        # The changed paragraph is replaced, and the unchanged paragraph is
+        # kept with the new page hash
+        assert docs["2"]["content"]["texts"] == ["Åpent i julen"]
+        assert docs["1"]["content"]["texts"] == ["Åpent alle dager"]
+        assert docs["1"]["page_hash"] == docs["2"]["page_hash"] == "new"
+    finally:
+        drop_collections()
+
+
+def test_update_removes_paragraphs():
+    try:
+        docs = update_page()
+
+        assert "3" not in docs
+    finally:
+        drop_collections()
+
+
+def test_update_keeps_missing_pages():
+    try:
+        docs = update_page()
+
+        assert docs["4"]["content"]["texts"] == ["Annen side"]
+        assert docs["4"]["page_hash"] == "old"
+    finally:
+        drop_collections()
+
+
+def get_conflicts(prod_doc, scraped_doc):
+    """ Refresh a manually changed document, which is stored in prod as
+    prod_doc, with scraped_doc. Returns the conflicts """
+    drop_collections()
+    fact.post_documents([prod_doc], "test_prod")
+    fact.post_documents([dict(prod_doc, manually_changed=True)],
+                        "test_manual")
+
+    return insert_documents([scraped_doc], temp_col=TEMP_COL, **COLLECTIONS)
+
+
+def test_conflict_on_changed_content():
+    stored = make_doc("1", PAGE, ["Åpent alle dager"])
+
+    try:
+        changed_texts = make_doc("1", PAGE, ["Stengt alle dager"])
+        assert get_conflicts(stored, changed_texts) == [
+            {"id": "1", "title": "Åpningstider"}]
+
+        changed_title = make_doc("1", PAGE, ["Åpent alle dager"],
+                                 title="Stengt")
+        assert get_conflicts(stored, changed_title) == [
+            {"id": "1", "title": "Stengt"}]
+        assert fact.get_collection("test_conflicts").count_documents(
+            {"id": "1"}) == 1
+    finally:
+        drop_collections()
+
+
+def test_no_conflict_on_changed_keywords():
+    stored = make_doc("1", PAGE, ["Åpent alle dager"])
+    scraped = make_doc("1", PAGE, ["Åpent alle dager"])
+    scraped["content"]["keywords"] = [{"keyword": "åpen", "confidence": 0.5}]
+
+    try:
+        assert get_conflicts(stored, scraped) == []
+
+        # The document is still marked as manually changed in prod
+        doc = fact.get_collection("test_prod").find_one({"id": "1"})
+        assert doc["manually_changed"]
+    finally:
+        drop_collections()
+
+
+def test_conflict_without_content_hash():
+    # Documents stored before content hashes get them computed
+    stored = make_doc("1", PAGE, ["Åpent alle dager"])
+    del stored["content_hash"]
+
+    try:
+        assert get_conflicts(stored, make_doc("1", PAGE,
+                                              ["Åpent alle dager"])) == []
+        assert get_conflicts(stored, make_doc("1", PAGE,
+                                              ["Stengt alle dager"])) == [
+            {"id": "1", "title": "Åpningstider"}]
+    finally:
+        drop_collections()
@@ -1,6 +1,23 @@
 #!/bin/bash
 
-if ! [ -f "chatbot/scraper/scraped.json" ]; then
-	scrapy crawl info_gathering -o chatbot/scraper/scraped.json
+# Set INCREMENTAL to only scrape and insert the pages which changed since the
+# last crawl.
+if [ -n "$INCREMENTAL" ]; then
+	# Keywords are scored with the model of the last full refresh
+	KEYWORD_MODEL_FILE=$(python -c 'import json; print(json.load(open("chatbot/settings.json"))["model"]["keyword_model_file"])')
+	if ! [ -f "$KEYWORD_MODEL_FILE" ]; then
+		echo "No keyword model at $KEYWORD_MODEL_FILE, run a full refresh first" >&2
+		exit 1
+	fi
+
+	rm -f chatbot/scraper/changed.jl
+	scrapy crawl info_gathering -a incremental=true -o chatbot/scraper/changed.jl || exit
+	# The crawl state is only committed when the changed pages are written
+	python chatbot/launch.py chatbot/scraper/changed.jl --incremental
+	exit
+fi
+
+if ! [ -f "chatbot/scraper/scraped.jl" ]; then
+	scrapy crawl info_gathering -o chatbot/scraper/scraped.jl
 fi
-python chatbot/launch.py chatbot/scraper/scraped.json
+python chatbot/launch.py chatbot/scraper/scraped.jl
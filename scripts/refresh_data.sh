@@ -3,5 +3,5 @@
 # To insert this into cron use the command: `crontab -e` and insert this line:
 # `0 0 * * *  bash <path_to_this_script>`
 cd /usr/src/app
-rm scraper/scraped.json
+rm scraper/scraped.jl
 bash launch.sh